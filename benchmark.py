@@ -0,0 +1,460 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+import http.server
+from pathlib import Path
+
+from epic_downloader import EpicDownloader, UrllibTransport, format_size, parse_rate, parse_size, print_header
+
+# benchmarks for the hot paths of the downloader, run against a local server that serves synthetic files laid out like
+# the EPIC-55, EPIC-100 and masks datasets. Use `python benchmark.py --help` for the options
+
+BENCHMARKS = ('planning', 'throughput', 'small_files', 'verify')
+LARGE_WHAT = ('videos', 'rgb_frames', 'flow_frames', 'object_detection_images')
+SMALL_WHAT = ('metadata', 'masks')
+FRAME_SIZE = 16 * 1024
+RANGE_MODES = ('honour', 'ignore', 'reject', 'misalign')
+
+
+class SyntheticHandler(http.server.BaseHTTPRequestHandler):
+    # serves the files under server.root with keep-alive, HEAD and Range support. The server can add latency to every
+    # new connection (standing in for the TCP and TLS handshakes) and response, cap the bandwidth of each response and
+    # cut every n-th response in the middle. Like some real servers, it always advertises Accept-Ranges but can be told
+    # to ignore Range headers (200 with the whole file), reject them (416) or misalign them (206 from the first byte)
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # otherwise small responses wait for the client's delayed ACKs
+
+    def setup(self):
+        super().setup()
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def send_response(self, code, message=None):
+        self.server.served.append((self.command, self.path, self.headers.get('Range'), code))
+        super().send_response(code, message)
+
+    def send_empty(self, code, headers=()):
+        self.send_response(code)
+
+        for name, value in headers:
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def serve(self, body):
+        server = self.server
+        path = os.path.join(server.root, self.path.split('?')[0].lstrip('/'))
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if '..' in self.path.split('/') or not os.path.isfile(path):
+            self.send_empty(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+
+        if match and server.ranges == 'reject':
+            self.send_empty(416, [('Content-Range', 'bytes */{}'.format(size))])
+            return
+
+        if match and server.ranges != 'ignore':
+            start = int(match.group(1)) if server.ranges == 'honour' else 0
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+
+            if start >= size:
+                self.send_empty(416, [('Content-Range', 'bytes */{}'.format(size))])
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if not body:
+            return
+
+        length = end - start + 1
+        cut_at = length // 2 if server.should_disconnect() else None
+        sent = 0
+        began = time.monotonic()
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+
+            while sent < length:
+                chunk = f.read(min(256 * 1024, length - sent, cut_at - sent if cut_at else length))
+
+                if not chunk:
+                    break
+
+                self.wfile.write(chunk)
+                sent += len(chunk)
+
+                if cut_at is not None and sent >= cut_at:
+                    self.close_connection = True
+                    return
+
+                if server.bandwidth:
+                    ahead = sent / server.bandwidth - (time.monotonic() - began)
+
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+
+class SyntheticServer(getattr(http.server, 'ThreadingHTTPServer', http.server.HTTPServer)):
+    daemon_threads = True
+
+    def __init__(self, address, root, latency=0, bandwidth=None, disconnect_every=0, ranges='honour'):
+        super().__init__(address, SyntheticHandler)
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.disconnect_every = disconnect_every
+        self.ranges = ranges
+        self.served = []  # (method, path, Range header, status) of every response
+        self.responses = 0
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # clients hang up in the middle of responses they don't want, e.g. those with a misaligned range
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def should_disconnect(self):
+        with self._lock:
+            self.responses += 1
+            return bool(self.disconnect_every) and self.responses % self.disconnect_every == 0
+
+
+def synthetic_content(key, size):
+    # deterministic content for a file, different for every file
+    pattern = hashlib.sha256(key.encode()).digest() * 2048
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def write_synthetic_tar(path, key, size):
+    # a tar of fake jpeg frames named like the real ones, e.g. ./frame_0000000001.jpg
+    with tarfile.open(path, 'w') as tar:
+        for i in range(max(1, size // (FRAME_SIZE + 512))):
+            data = synthetic_content('{}/{}'.format(key, i), FRAME_SIZE)
+            info = tarfile.TarInfo('./frame_{:010d}.jpg'.format(i + 1))
+            info.size = len(data)
+            info.mtime = 0
+            tar.addfile(info, io.BytesIO(data))
+
+
+def pick_videos(count):
+    # the same number of EPIC-55 and extension videos, spread over the participants
+    with open('data/epic_100_splits.csv') as f:
+        video_ids = [line.split(',')[0] for line in f.read().splitlines()[1:]]
+
+    epic_55 = [v for v in video_ids if len(v.split('_')[1]) == 2]
+    extension = [v for v in video_ids if len(v.split('_')[1]) == 3]
+    n_55 = (count + 1) // 2
+    n_100 = count - n_55
+
+    return ([epic_55[i * len(epic_55) // n_55] for i in range(n_55)] +
+            [extension[i * len(extension) // n_100] for i in range(n_100)])
+
+
+def generate_dataset(work_dir, url, videos, large_size, small_size):
+    # writes the files served by the synthetic server under work_dir/server, together with the md5.csv describing
+    # them. The first extension video is served as an erratum, from a different path like the real ones. The errata
+    # urls are written to errata_template.csv relative to `url`, since the port of the server changes at every run
+    root = os.path.join(work_dir, 'server')
+    signature = json.dumps([videos, large_size, small_size])
+    signature_path = os.path.join(work_dir, 'dataset.json')
+
+    if os.path.exists(signature_path):
+        with open(signature_path) as f:
+            if f.read() == signature:
+                return root
+
+    shutil.rmtree(root, ignore_errors=True)
+    empty_csv = os.path.join(work_dir, 'empty.csv')
+
+    with open(empty_csv, 'w') as f:
+        f.write('md5,file_remote_path,version,rdsf_path,dropbox_path\n')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        downloader = EpicDownloader(epic_55_base_url=url + '/55', epic_100_base_url=url + '/100',
+                                    masks_base_url=url + '/masks', base_output=os.path.join(work_dir, 'generate'),
+                                    md5_path=empty_csv, errata_path=empty_csv)
+
+    video_dicts = {v['video_id']: v for v, _ in downloader.video_splits() if v['video_id'] in videos}
+    erratum_video = next(v for v in videos if len(v.split('_')[1]) == 3)
+    md5_rows = []
+    errata_rows = []
+
+    for what in downloader.manifest_what:
+        for job in downloader.jobs(what, video_dicts):
+            version = job.version
+            relative_path = job.url[len(url) + 1:]
+
+            if job.video_id == erratum_video and what in ('rgb_frames', 'flow_frames', 'masks'):
+                relative_path = 'errata/{}'.format(job.remote_key.replace('/', '_'))
+                errata_rows.append((job.remote_key, '{}/{}?dl=1'.format(url, relative_path)))
+                version = 'errata'
+
+            path = os.path.join(root, relative_path)
+            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+
+            if what in ('rgb_frames', 'flow_frames', 'object_detection_images'):
+                write_synthetic_tar(path, job.remote_key, large_size)
+            else:
+                with open(path, 'wb') as f:
+                    f.write(synthetic_content(job.remote_key, large_size if what in LARGE_WHAT else small_size))
+
+            md5_rows.append((EpicDownloader.md5_checksum(path), job.remote_key, version))
+
+    with open(os.path.join(work_dir, 'md5.csv'), 'w') as f:
+        f.write('md5,file_remote_path,version\n')
+        f.writelines('{},{},{}\n'.format(*row) for row in md5_rows)
+
+    with open(os.path.join(work_dir, 'errata_template.csv'), 'w') as f:
+        f.write('rdsf_path,dropbox_path\n')
+        f.writelines('{},{}\n'.format(*row) for row in errata_rows)
+
+    with open(signature_path, 'w') as f:
+        f.write(signature)
+
+    return root
+
+
+def start_server(root, latency=0, bandwidth=None, disconnect_every=0, ranges='honour'):
+    # the server runs in its own process, so that it does not compete with the downloader for the GIL
+    args = [sys.executable, os.path.abspath(__file__), '--serve', root, '--latency', str(latency),
+            '--disconnect-every', str(disconnect_every), '--ranges', ranges]
+
+    if bandwidth:
+        args += ['--server-bandwidth', str(bandwidth)]
+
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
+    port = int(process.stdout.readline())
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+
+def serve(root, latency=0, bandwidth=None, disconnect_every=0, ranges='honour'):
+    server = SyntheticServer(('127.0.0.1', 0), root, latency=latency, bandwidth=bandwidth,
+                             disconnect_every=disconnect_every, ranges=ranges)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+
+def output_size(output):
+    return sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(output) for name in names
+               if not name.startswith('.') and not name.endswith('.json'))
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = args.work_dir
+        self.videos = pick_videos(args.videos)
+        self.server = None
+        self.url = None
+
+    def downloader(self, output, **kwargs):
+        options = dict(epic_55_base_url=self.url + '/55', epic_100_base_url=self.url + '/100',
+                       masks_base_url=self.url + '/masks', base_output=output,
+                       md5_path=os.path.join(self.work_dir, 'md5.csv'),
+                       errata_path=os.path.join(self.work_dir, 'errata.csv'), workers=self.args.workers,
+                       segments=self.args.segments, segment_threshold=self.args.segment_threshold,
+                       retry_backoff=0)
+        options.update(kwargs)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            return EpicDownloader(**options)
+
+    def run(self, benchmarks):
+        self.server, self.url = start_server(os.path.join(self.work_dir, 'server'), latency=self.args.latency,
+                                             bandwidth=self.args.server_bandwidth,
+                                             disconnect_every=self.args.disconnect_every, ranges=self.args.ranges)
+
+        try:
+            generate_dataset(self.work_dir, 'http://synthetic', self.videos, self.args.large_size,
+                             self.args.small_size)
+            self.write_errata()
+            return {name: getattr(self, name)() for name in benchmarks}
+        finally:
+            self.server.terminate()
+            self.server.wait()
+
+    def write_errata(self):
+        with open(os.path.join(self.work_dir, 'errata_template.csv')) as f:
+            errata = f.read()
+
+        with open(os.path.join(self.work_dir, 'errata.csv'), 'w') as f:
+            f.write(errata.replace('http://synthetic', self.url))
+
+    def planning(self):
+        # startup and selection over the real csv files, which need no server
+        output = os.path.join(self.work_dir, 'planning')
+        shutil.rmtree(output, ignore_errors=True)
+        what = LARGE_WHAT + SMALL_WHAT
+
+        def best(func, runs=5):
+            return min((timed(func) for _ in range(runs)), key=lambda r: r[1])
+
+        downloader, startup = best(lambda: EpicDownloader(base_output=output))
+        jobs, plan = best(lambda: list(downloader.plan(what)))
+        _, selection = best(lambda: list(downloader.plan(what, participants=[1, 2, 3], splits=['test'])))
+
+        return {'startup_seconds': startup, 'plan_seconds': plan, 'planned_files': len(jobs),
+                'filtered_plan_seconds': selection}
+
+    def download(self, what, output_name='download', **kwargs):
+        output = os.path.join(self.work_dir, output_name)
+        shutil.rmtree(os.path.join(output, 'EPIC-KITCHENS'), ignore_errors=True)
+        downloader = self.downloader(output, **kwargs)
+        _, seconds = timed(downloader.download, what=what, specific_videos=self.videos)
+        files = len(list(downloader.plan(what, specific_videos=self.videos)))
+        size = output_size(os.path.join(output, 'EPIC-KITCHENS'))
+
+        return {'files': files, 'failed': len(downloader.failed_downloads), 'bytes': size, 'seconds': seconds,
+                'bytes_per_second': size / seconds, 'files_per_second': files / seconds}
+
+    def throughput(self):
+        return self.download(LARGE_WHAT)
+
+    def small_files(self):
+        return {'keep_alive': self.download(SMALL_WHAT),
+                'no_keep_alive': self.download(SMALL_WHAT, transport=UrllibTransport())}
+
+    def verify(self):
+        # hashes every file of the dataset, downloading them first if needed
+        output = os.path.join(self.work_dir, 'verify')
+        what = LARGE_WHAT + SMALL_WHAT
+
+        if not os.path.exists(os.path.join(output, 'EPIC-KITCHENS')):
+            self.download(what, output_name='verify')
+
+        downloader = self.downloader(output, hash_workers=self.args.hash_workers)
+        summary, seconds = timed(downloader.verify, what=what, specific_videos=self.videos,
+                                 report_path=os.path.join(self.work_dir, 'verify_report.json'))
+        size = output_size(os.path.join(output, 'EPIC-KITCHENS'))
+
+        return {'files': sum(summary.values()), 'ok': summary['ok'], 'bytes': size, 'seconds': seconds,
+                'bytes_per_second': size / seconds}
+
+
+def print_results(results):
+    for name, result in results.items():
+        print_header('| {} |'.format(name), char='-')
+        rows = result.items() if all(isinstance(v, dict) for v in result.values()) else [('', result)]
+
+        for label, row in rows:
+            for key, value in row.items():
+                if key == 'bytes_per_second':
+                    value = '{}/s'.format(format_size(value))
+                elif key == 'bytes':
+                    value = format_size(value)
+                elif isinstance(value, float):
+                    value = '{:.3f}'.format(value)
+
+                print('{:<40}{}'.format(' '.join(x for x in (label, key) if x), value))
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks the downloader against a local server serving synthetic '
+                                                 'files laid out like the EPIC-KITCHENS datasets')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run, out of {}. Default is all of them'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='Where to keep the synthetic files and the downloads. The synthetic files are reused by '
+                             'following runs. Default is a temporary folder deleted at the end')
+    parser.add_argument('--videos', type=int, default=6, help='Number of synthetic videos. Default is 6')
+    parser.add_argument('--large-size', type=parse_size, default='16M',
+                        help='Size of videos and of rgb, flow and object detection tars. Default is 16M')
+    parser.add_argument('--small-size', type=parse_size, default='16K',
+                        help='Size of metadata and masks files. Default is 16K')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds the server waits before every response and every new connection. Default is 0')
+    parser.add_argument('--server-bandwidth', type=parse_rate, default=None,
+                        help='Maximum rate the server sends each response at, e.g. 10M. Default is no limit')
+    parser.add_argument('--disconnect-every', type=int, default=0,
+                        help='The server drops the connection halfway through every n-th response. Default is never')
+    parser.add_argument('--ranges', type=str, choices=RANGE_MODES, default='honour',
+                        help='How the server answers Range requests: honour them, ignore them and send the whole file, '
+                             'reject them with 416 or misalign them by sending the file from its first byte. Default '
+                             'is honour')
+    parser.add_argument('--workers', type=int, default=4, help='Downloader --workers. Default is 4')
+    parser.add_argument('--segments', type=int, default=1, help='Downloader --segments. Default is 1')
+    parser.add_argument('--segment-threshold', type=parse_size, default='1G',
+                        help='Downloader --segment-threshold. Default is 1G')
+    parser.add_argument('--hash-workers', type=int, default=None,
+                        help='Downloader --hash-workers. Default is the number of CPUs')
+    parser.add_argument('--json', type=str, default=None, help='Also write the results to this json file')
+    parser.add_argument('--serve', type=str, default=None, help=argparse.SUPPRESS)
+
+    return parser
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    parser = create_parser()
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}, choose from {}'.format(name, ', '.join(BENCHMARKS)))
+
+    if args.serve is not None:
+        serve(args.serve, latency=args.latency, bandwidth=args.server_bandwidth,
+              disconnect_every=args.disconnect_every, ranges=args.ranges)
+        sys.exit(0)
+
+    temporary = args.work_dir is None
+    args.work_dir = tempfile.mkdtemp(prefix='epic-benchmark-') if temporary else os.path.abspath(args.work_dir)
+    Path(args.work_dir).mkdir(parents=True, exist_ok=True)
+
+    try:
+        results = Benchmark(args).run(args.benchmarks or BENCHMARKS)
+    finally:
+        if temporary:
+            shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    print_results(results)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -1,92 +1,1661 @@
 import argparse
+import datetime
 import hashlib
+import heapq
+import json
+import mmap
 import os
-import csv
+import queue
 import shutil
+import sqlite3
+import struct
+import csv
 import sys
+import tarfile
+import threading
+import time
 import warnings
 
 try:
+    import http.client
+    import http.server
+    import ssl
     import urllib.request
     import urllib.error
+    from concurrent.futures import ThreadPoolExecutor
     from pathlib import Path
+    from urllib.parse import urljoin, urlparse
 except ImportError as e:
     print('Error: {}'.format(e))
     print('This script works with Python 3.5+. Please use a more recent version of Python')
     exit(-1)
 
 
-def print_header(header, char='*'):
-    print()
-    print(char * len(header))
-    print(header)
-    print(char * len(header))
-    print()
+COPY_BUFSIZE = 1024 * 1024
+HASH_BUFSIZE = 8 * 1024 * 1024
+FICLONE = 0x40049409  # from linux/fs.h
+FRAME_INDEX_MAGIC = b'EPICTIX1'
+FRAME_INDEX_HEADER = struct.Struct('<8sQI')  # magic, size of the tar, number of entries
+FRAME_INDEX_ENTRY = struct.Struct('<QQH')  # offset, size, length of the name that follows
+
+_hash_buffers = threading.local()
+
+
+def print_header(header, char='*'):
+    print()
+    print(char * len(header))
+    print(header)
+    print(char * len(header))
+    print()
+
+
+def format_size(n):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if n < 1024 or unit == 'TB':
+            return '{:.1f} {}'.format(n, unit) if unit != 'B' else '{} B'.format(n)
+
+        n /= 1024
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    return '{}d {:02d}h {:02d}m'.format(days, hours, minutes) if days else '{:02d}h {:02d}m {:02d}s'.format(
+        hours, minutes, seconds)
+
+
+def parse_size(s):
+    # accepts plain numbers of bytes or human friendly values such as 500K, 200M, 1.5G
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    s = str(s).strip().upper().rstrip('B')
+    unit = s[-1] if s and s[-1] in units else ''
+    value = s[:-1] if unit else s
+
+    try:
+        return int(float(value) * units[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid size: {}'.format(s))
+
+
+def pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        written = os.pwrite(fd, data, offset)
+    else:
+        # no pwrite on Windows: this is safe as long as each thread writes through its own file descriptor
+        os.lseek(fd, offset, os.SEEK_SET)
+        written = os.write(fd, data)
+
+    if written < len(data):
+        pwrite(fd, memoryview(data)[written:], offset + written)
+
+
+def parse_rate(s):
+    # a rate in bytes per second, e.g. 200M or 200M/s. Rates in bits per second such as 50Mbit are also accepted, as
+    # well as `unlimited`, which is returned as None
+    s = str(s).strip()
+
+    if s.endswith('/s'):
+        s = s[:-2]
+
+    if s.lower() in ('unlimited', 'none'):
+        return None
+
+    if s.lower().endswith('bit'):
+        units = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3}
+        value = s[:-3].strip().upper()
+        unit = value[-1] if value and value[-1] in units else ''
+
+        try:
+            rate = float(value[:-1] if unit else value) * units[unit] / 8
+        except ValueError:
+            raise argparse.ArgumentTypeError('Invalid rate: {}'.format(s))
+    else:
+        try:
+            rate = parse_size(s)
+        except OverflowError:
+            raise argparse.ArgumentTypeError('Invalid rate: {}'.format(s))
+
+    # use `unlimited` to lift a limit, a rate of zero would never let any data through
+    if not rate > 0:
+        raise argparse.ArgumentTypeError('Invalid rate: {}, rates must be greater than zero'.format(s))
+
+    return rate
+
+
+def parse_host_rate(s):
+    host, _, rate = s.partition('=')
+
+    if not host or not rate:
+        raise argparse.ArgumentTypeError('Invalid host rate {}, expected HOST=RATE'.format(s))
+
+    return host, parse_rate(rate)
+
+
+def clone_file(source, destination):
+    # makes destination a copy on write clone of source (a reflink, on filesystems such as btrfs or XFS), a hard link
+    # to it or a plain copy, whichever works first. Returns which one was made
+    tmp_path = destination + '.tmp'
+
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    try:
+        import fcntl
+
+        with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+        method = 'reflink'
+    except (ImportError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        try:
+            os.link(source, tmp_path)
+            method = 'hardlink'
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+            method = 'copy'
+
+    os.replace(tmp_path, destination)
+    return method
+
+
+class RateSchedule:
+    # daily time windows with their own rate, e.g. `07:00-22:00=50Mbit,22:00-07:00=unlimited`. Windows can wrap
+    # around midnight. rate_at returns the rate of the window the given time falls in and `default` otherwise
+    def __init__(self, spec, default=None):
+        self.default = default
+        self.windows = []
+
+        for window in spec.split(','):
+            try:
+                times, rate = window.split('=')
+                start, end = (self.parse_time(t) for t in times.split('-'))
+            except ValueError:
+                raise argparse.ArgumentTypeError('Invalid rate schedule window: {}'.format(window))
+
+            self.windows.append((start, end, parse_rate(rate)))
+
+    @staticmethod
+    def parse_time(s):
+        hours, minutes = s.strip().split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def rate_at(self, now):
+        minute = now.hour * 60 + now.minute
+
+        for start, end, rate in self.windows:
+            if start <= minute < end or (start > end and (minute >= start or minute < end)):
+                return rate
+
+        return self.default
+
+
+class TokenBucket:
+    # a token bucket shared by any number of threads. consume() blocks until the caller is allowed to transfer n more
+    # bytes. The rate comes from a function so that it can change while transfers are running
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate if callable(rate) else (lambda: rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = 0
+        self.last = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        with self._lock:
+            now = self.clock()
+            rate = self.rate()
+
+            if rate is None or rate <= 0:
+                # parse_rate never returns such rates, anything that isn't a positive rate is treated as unlimited
+                self.tokens, self.last = 0, now
+                return
+
+            burst = max(rate, COPY_BUFSIZE)  # at most a second worth of data
+            self.tokens = min(burst, self.tokens + (now - self.last) * rate) - n
+            self.last = now
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+
+        if wait:
+            self.sleep(wait)
+
+
+class RateLimiter:
+    # limits the overall download rate, optionally following a schedule, and the rate of individual hosts
+    def __init__(self, max_rate=None, schedule=None, host_rates=None, clock=time.monotonic, sleep=time.sleep,
+                 now=datetime.datetime.now):
+        self.max_rate = max_rate
+        self.schedule = schedule
+        self.now = now
+        self.bucket = TokenBucket(self.current_rate, clock=clock, sleep=sleep)
+        self.host_buckets = {host: TokenBucket(rate, clock=clock, sleep=sleep)
+                             for host, rate in (host_rates or {}).items()}
+
+    def current_rate(self):
+        if self.schedule is None:
+            return self.max_rate
+
+        return self.schedule.rate_at(self.now())
+
+    def consume(self, host, n):
+        if host in self.host_buckets:
+            self.host_buckets[host].consume(n)
+
+        self.bucket.consume(n)
+
+
+def parse_shard(s):
+    try:
+        index, count = (int(x) for x in s.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid shard {}, expected INDEX/COUNT, e.g. 0/4'.format(s))
+
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('Invalid shard {}, INDEX must be between 0 and COUNT - 1'.format(s))
+
+    return index, count
+
+
+def check_shard_manifests(paths):
+    # returns a list of problems found in the manifests written by the shards of a download, empty if together they
+    # cover the whole selection exactly once
+    manifests = []
+
+    for path in paths:
+        with open(path) as f:
+            manifests.append(json.load(f))
+
+    if not manifests:
+        return ['no shard manifests given']
+
+    problems = []
+    reference = manifests[0]
+
+    for m in manifests:
+        if (m['count'], m['selection_digest']) != (reference['count'], reference['selection_digest']):
+            problems.append('shard {}/{} was planned for a different selection or number of shards'.format(
+                m['shard'], m['count']))
+
+    missing = set(range(reference['count'])) - {m['shard'] for m in manifests}
+
+    if missing:
+        problems.append('missing manifests for shards {}'.format(', '.join(str(i) for i in sorted(missing))))
+
+    seen = set()
+
+    for m in manifests:
+        keys = {job['remote_key'] for job in m['jobs']}
+
+        if keys & seen:
+            problems.append('shard {} shares {} files with other shards'.format(m['shard'], len(keys & seen)))
+
+        seen |= keys
+
+    if not missing and len(seen) != reference['total_jobs']:
+        problems.append('the shards cover {} files out of {}'.format(len(seen), reference['total_jobs']))
+
+    return problems
+
+
+class Transfer:
+    # one attempt at downloading a file
+    __slots__ = ('url', 'path', 'host', 'attempt', 'bytes', 'start')
+
+    def __init__(self, url, path, attempt, start):
+        self.url = url
+        self.path = path
+        self.host = urlparse(url).netloc
+        self.attempt = attempt
+        self.bytes = 0
+        self.start = start
+
+
+class Metrics:
+    # counters and gauges about downloads and hashing. Events are appended as json lines to events_path, metrics are
+    # written in the Prometheus text format to metrics_path every `interval` seconds and served on metrics_port (on the
+    # local machine only, unless another metrics_host is given)
+    prefix = 'epic_downloader_'
+    descriptions = {
+        'bytes_downloaded_total': ('counter', 'Bytes downloaded'),
+        'download_seconds_total': ('counter', 'Seconds spent downloading, summed over concurrent transfers'),
+        'files_downloaded_total': ('counter', 'Files downloaded and verified'),
+        'files_skipped_total': ('counter', 'Files skipped because they had already been downloaded'),
+        'download_failures_total': ('counter', 'Failed download attempts'),
+        'retries_total': ('counter', 'Failed download attempts that are tried again'),
+        'bytes_hashed_total': ('counter', 'Bytes of local files hashed to verify them'),
+        'hash_seconds_total': ('counter', 'Seconds spent hashing local files'),
+        'check_seconds_total': ('counter', 'Seconds spent checking whether files had already been downloaded'),
+        'files_from_mirror_total': ('counter', 'Files copied from a mirror instead of being downloaded'),
+        'active_transfers': ('gauge', 'Files being downloaded'),
+        'queue_depth': ('gauge', 'Files waiting for a worker'),
+        'download_bytes_per_second': ('gauge', 'Download throughput over the last interval'),
+        'hash_bytes_per_second': ('gauge', 'Hashing throughput over the last interval'),
+    }
+
+    def __init__(self, events_path=None, metrics_path=None, metrics_port=None, metrics_host='127.0.0.1', interval=10,
+                 clock=time.monotonic):
+        self.events_path = events_path
+        self.metrics_path = metrics_path
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.interval = interval
+        self.clock = clock
+        self.values = {}  # (name, labels) -> value, where labels is a tuple of (label, value) pairs
+        self.transfers = set()
+        self.events_file = None
+        self.server = None
+        self._last_totals = None
+        self._stopped = threading.Event()
+        self._ticker = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return any(x is not None for x in (self.events_path, self.metrics_path, self.metrics_port))
+
+    def start(self):
+        if self.events_path is not None:
+            Path(os.path.dirname(os.path.abspath(self.events_path))).mkdir(parents=True, exist_ok=True)
+            self.events_file = open(self.events_path, 'a')
+
+        if self.metrics_port is not None:
+            metrics = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            server_class = getattr(http.server, 'ThreadingHTTPServer', http.server.HTTPServer)  # Python 3.7+
+            self.server = server_class((self.metrics_host, self.metrics_port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        if self.enabled:
+            self._last_totals = (self.clock(), 0, 0)
+            self._ticker = threading.Thread(target=self.tick_forever, daemon=True)
+            self._ticker.start()
+
+    def close(self):
+        if self._ticker is not None:
+            self._stopped.set()
+            self._ticker.join()
+            self._ticker = None
+            self.tick()
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+        if self.events_file is not None:
+            self.events_file.close()
+            self.events_file = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def total(self, name):
+        with self._lock:
+            return sum(value for (n, _), value in self.values.items() if n == name)
+
+    def event(self, event, **fields):
+        if self.events_file is None:
+            return
+
+        line = json.dumps(dict({'time': time.time(), 'event': event}, **fields))
+
+        with self._lock:
+            if self.events_file is not None:
+                self.events_file.write(line + '\n')
+                self.events_file.flush()
+
+    def start_transfer(self, url, path, attempt):
+        transfer = Transfer(url, path, attempt, self.clock())
+
+        with self._lock:
+            self.transfers.add(transfer)
+
+        self.inc('active_transfers')
+        self.event('download_started', url=url, path=path, attempt=attempt)
+        return transfer
+
+    def transferred(self, transfer, n):
+        with self._lock:  # the segments of a file share its transfer
+            transfer.bytes += n
+
+        self.inc('bytes_downloaded_total', n, host=transfer.host)
+
+    def finish_transfer(self, transfer, error=None, will_retry=False, verified=True):
+        # verified is False for downloads left to the verify stage, which counts them once they are verified
+        seconds = self.clock() - transfer.start
+
+        with self._lock:
+            self.transfers.discard(transfer)
+
+        self.inc('active_transfers', -1)
+        self.inc('download_seconds_total', seconds)
+        fields = dict(url=transfer.url, path=transfer.path, attempt=transfer.attempt, bytes=transfer.bytes,
+                      seconds=round(seconds, 3))
+
+        if error is None:
+            if verified:
+                self.inc('files_downloaded_total')
+
+            self.event('download_finished', **fields)
+            return
+
+        self.inc('download_failures_total', host=transfer.host)
+
+        if will_retry:
+            self.inc('retries_total')
+
+        self.event('download_failed', error=str(error), will_retry=will_retry, **fields)
+
+    def hashed(self, path, n_bytes, seconds):
+        self.inc('bytes_hashed_total', n_bytes)
+        self.inc('hash_seconds_total', seconds)
+        self.event('hashed', path=path, bytes=n_bytes, seconds=round(seconds, 3))
+
+    def skipped(self, path, check_seconds):
+        self.inc('files_skipped_total')
+        self.inc('check_seconds_total', check_seconds)
+        self.event('skipped', path=path, check_seconds=round(check_seconds, 3))
+
+    def tick(self):
+        # updates the throughput gauges, reports the progress of running transfers and writes the metrics file
+        now, downloaded, hashed = self.clock(), self.total('bytes_downloaded_total'), self.total('bytes_hashed_total')
+
+        if self._last_totals is not None:
+            last_time, last_downloaded, last_hashed = self._last_totals
+            elapsed = max(now - last_time, 1e-6)
+            self.set('download_bytes_per_second', (downloaded - last_downloaded) / elapsed)
+            self.set('hash_bytes_per_second', (hashed - last_hashed) / elapsed)
+
+        self._last_totals = (now, downloaded, hashed)
+
+        with self._lock:
+            transfers = [(transfer, transfer.bytes) for transfer in self.transfers]
+
+        for transfer, received in transfers:
+            self.event('progress', url=transfer.url, path=transfer.path, bytes=received,
+                       seconds=round(now - transfer.start, 3))
+
+        if self.metrics_path is not None:
+            Path(os.path.dirname(os.path.abspath(self.metrics_path))).mkdir(parents=True, exist_ok=True)
+            tmp_path = self.metrics_path + '.tmp'
+
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+
+            os.replace(tmp_path, self.metrics_path)  # the textfile collector must never see a partial file
+
+    def tick_forever(self):
+        while not self._stopped.wait(self.interval):
+            self.tick()
+
+    def render(self):
+        with self._lock:
+            values = dict(self.values)
+
+        lines = []
+
+        for name, (kind, description) in self.descriptions.items():
+            lines.append('# HELP {}{} {}'.format(self.prefix, name, description))
+            lines.append('# TYPE {}{} {}'.format(self.prefix, name, kind))
+            samples = sorted((labels, value) for (n, labels), value in values.items() if n == name) or [((), 0)]
+
+            for labels, value in samples:
+                labels_str = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for k, v in labels)
+                lines.append('{}{}{} {}'.format(self.prefix, name, '{' + labels_str + '}' if labels else '',
+                                                round(value, 6) if isinstance(value, float) else value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class ChecksumMismatch(IOError):
+    pass
+
+
+class DownloadStopped(Exception):
+    pass
+
+
+def is_safe_member(member):
+    # used when tarfile has no data filter: only plain files and folders that stay inside the output folder are
+    # extracted. Links are rejected, since later members could be written through them to anywhere on disk
+    parts = member.name.replace('\\', '/').split('/')
+    return (member.isfile() or member.isdir()) and not os.path.isabs(member.name) and '..' not in parts
+
+
+def is_retryable(error):
+    # client errors such as 404 will not go away by trying again, except for timeouts and rate limiting
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code in (408, 429)
+
+    return True
+
+
+class DownloadJob:
+    __slots__ = ('url', 'output_path', 'remote_key', 'version', 'video_id', 'what')
+
+    def __init__(self, url, output_path, remote_key, version, video_id=None, what=None):
+        self.url = url
+        self.output_path = output_path
+        self.remote_key = remote_key
+        self.version = version
+        self.video_id = video_id
+        self.what = what
+
+    @property
+    def host(self):
+        return urlparse(self.url).netloc
+
+
+class HashingReader:
+    # wraps a file-like object and hashes everything read through it
+    def __init__(self, fileobj, hash_md5, on_read=None):
+        self.fileobj = fileobj
+        self.hash_md5 = hash_md5
+        self.on_read = on_read
+        self.bytes_read = 0
+
+    def read(self, n=-1):
+        data = self.fileobj.read(n) if n is not None and n >= 0 else self.fileobj.read()
+        self.hash_md5.update(data)
+        self.bytes_read += len(data)
+
+        if self.on_read is not None:
+            self.on_read(len(data))
+
+        return data
+
+
+class TarIndexer:
+    # parses a tar archive as it is downloaded, without buffering it, and collects the name, offset and size of every
+    # regular file in it. GNU long names and pax paths are supported. `complete` is set once the end of the archive has
+    # been reached, `error` if the data is not a tar archive this parser understands
+    def __init__(self):
+        self.entries = []
+        self.position = 0
+        self.header = bytearray()
+        self.payload = bytearray()
+        self.payload_left = 0
+        self.payload_type = None
+        self.skip = 0
+        self.long_name = None
+        self.complete = False
+        self.error = None
+
+    def feed(self, data):
+        data = memoryview(data)
+
+        while len(data) and not self.complete and self.error is None:
+            if self.skip:
+                n = min(self.skip, len(data))
+                self.skip -= n
+            elif self.payload_left:
+                n = min(self.payload_left, len(data))
+                self.payload += data[:n]
+                self.payload_left -= n
+            else:
+                n = min(512 - len(self.header), len(data))
+                self.header += data[:n]
+
+            data = data[n:]
+            self.position += n
+
+            try:
+                if self.payload_type is not None and not self.payload_left:
+                    self.end_payload()
+                elif len(self.header) == 512:
+                    self.end_header()
+            except ValueError as e:
+                self.error = e
+
+    @staticmethod
+    def padding(size):
+        return -size % 512
+
+    @staticmethod
+    def parse_number(field):
+        if field[0] & 0x80:  # base-256, used by GNU tar for large sizes
+            return int.from_bytes(field[1:], 'big')
+
+        field = bytes(field).split(b'\0')[0].strip()
+        return int(field, 8) if field else 0
+
+    def end_header(self):
+        header, self.header = bytes(self.header), bytearray()
+
+        if header == bytes(512):
+            self.complete = True
+            return
+
+        checksum = self.parse_number(header[148:156])
+        unsigned = sum(header[:148]) + 8 * 32 + sum(header[156:])
+        signed = sum(struct.unpack('148b', header[:148])) + 8 * 32 + sum(struct.unpack('356b', header[156:]))
+
+        if checksum not in (unsigned, signed):
+            raise ValueError('invalid tar header at offset {}'.format(self.position - 512))
+
+        size = self.parse_number(header[124:136])
+        kind = header[156:157]
+
+        if kind in (b'L', b'K', b'x', b'g'):
+            self.payload_type, self.payload_left, self.payload = kind, size, bytearray()
+
+            if not size:
+                self.end_payload()
+
+            return
+
+        if kind in (b'0', b'\0', b'7'):
+            name = header[:100].split(b'\0')[0]
+            prefix = header[345:500].split(b'\0')[0] if header[257:262] == b'ustar' else b''
+            name = self.long_name or (prefix + b'/' + name if prefix else name).decode('utf-8', 'surrogateescape')
+            self.entries.append((name, self.position, size))
+
+        self.long_name = None
+        self.skip = size + self.padding(size)
+
+    def end_payload(self):
+        kind, payload = self.payload_type, bytes(self.payload)
+        self.payload_type, self.payload = None, bytearray()
+        self.skip = self.padding(len(payload))
+
+        if kind == b'L':
+            self.long_name = payload.split(b'\0')[0].decode('utf-8', 'surrogateescape')
+        elif kind == b'x':
+            # records such as `30 path=some/very/long/name\n`
+            while payload:
+                length, _, rest = payload.partition(b' ')
+
+                if int(length) <= len(length):
+                    raise ValueError('invalid pax header at offset {}'.format(self.position))
+
+                record, payload = rest[:int(length) - len(length) - 2], payload[int(length):]
+                key, _, value = record.partition(b'=')
+
+                if key == b'path':
+                    self.long_name = value.decode('utf-8', 'surrogateescape')
+
+
+def scan_tar(path):
+    # the same entries TarIndexer collects, for an archive already on disk
+    with tarfile.open(path, 'r:') as tar:
+        return [(member.name, member.offset_data, member.size) for member in tar if member.isreg()]
+
+
+def frame_name(name):
+    return name[2:] if name.startswith('./') else name
+
+
+def write_frame_index(path, entries, tar_size):
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'wb') as f:
+        f.write(FRAME_INDEX_HEADER.pack(FRAME_INDEX_MAGIC, tar_size, len(entries)))
+
+        for name, offset, size in entries:
+            name = frame_name(name).encode('utf-8', 'surrogateescape')
+            f.write(FRAME_INDEX_ENTRY.pack(offset, size, len(name)))
+            f.write(name)
+
+    os.replace(tmp_path, path)
+
+
+def read_frame_index(path, tar_size=None):
+    # returns a dict mapping the name of every file in the archive to its offset and size, in archive order
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, indexed_size, count = FRAME_INDEX_HEADER.unpack_from(data)
+
+    if magic != FRAME_INDEX_MAGIC:
+        raise ValueError('{} is not a frame index'.format(path))
+
+    if tar_size is not None and tar_size != indexed_size:
+        raise ValueError('{} was built for a different archive'.format(path))
+
+    index = {}
+    position = FRAME_INDEX_HEADER.size
+
+    for _ in range(count):
+        offset, size, length = FRAME_INDEX_ENTRY.unpack_from(data, position)
+        position += FRAME_INDEX_ENTRY.size
+        index[data[position:position + length].decode('utf-8', 'surrogateescape')] = (offset, size)
+        position += length
+
+    return index
+
+
+class FrameArchive:
+    # random access to the frames of a downloaded tar through the index built with --index-frames, e.g.
+    #
+    #     with FrameArchive('P01/rgb_frames/P01_01.tar') as frames:
+    #         jpeg = frames['frame_0000000001.jpg']
+    #
+    # Frames are memoryviews into a read-only memory map of the tar, so reading one copies nothing and needs no system
+    # call. Views must be released before the archive is closed
+    def __init__(self, tar_path, index_path=None):
+        self.tar_path = tar_path
+        self.index = read_frame_index(tar_path + '.idx' if index_path is None else index_path,
+                                      os.path.getsize(tar_path))
+        self._file = open(tar_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+    def __getitem__(self, name):
+        offset, size = self.index[frame_name(name)]
+        return self._view[offset:offset + size]
+
+    def __contains__(self, name):
+        return frame_name(name) in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UrllibTransport:
+    # opens a new connection for every request. This honours the proxy settings found in the environment
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+
+    def open(self, url, headers=None, method=None):
+        request = urllib.request.Request(url, headers=headers or {}, method=method)
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def close(self):
+        pass
+
+
+class PooledResponse:
+    # a response whose connection goes back to the pool once the body has been fully read and the response closed
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def readinto(self, b):
+        return self.response.readinto(b)
+
+    def close(self):
+        if self.connection is None:
+            return
+
+        if not self.response.isclosed() and (self.response.length == 0 or self.response._method == 'HEAD'):
+            self.response.read()  # marks responses without a body as complete
+
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    # keeps up to `size` idle keep-alive connections per host, so that consecutive requests to the same host do not pay
+    # a new TCP and TLS handshake every time
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, size=4, timeout=60, max_redirects=5, proxies=None):
+        self.size = size
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self.proxy_transport = UrllibTransport(timeout=timeout)
+        self.idle = {}
+        self.ssl_context = None  # created with the first https connection, loading the certificates is slow
+        self._lock = threading.Lock()
+
+    def new_connection(self, key):
+        scheme, host, port = key
+
+        if scheme == 'https':
+            with self._lock:
+                if self.ssl_context is None:
+                    self.ssl_context = ssl.create_default_context()
+
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def acquire(self, key):
+        with self._lock:
+            connections = self.idle.get(key)
+
+            if connections:
+                return connections.pop(), True
+
+        return self.new_connection(key), False
+
+    def release(self, key, connection):
+        with self._lock:
+            connections = self.idle.setdefault(key, [])
+
+            if len(connections) < self.size:
+                connections.append(connection)
+                return
+
+        connection.close()
+
+    def request(self, url, headers, method):
+        parts = urlparse(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = dict({'User-Agent': 'epic-downloader'}, **(headers or {}))
+        connection, reused = self.acquire(key)
+
+        while True:
+            try:
+                connection.request(method, path, headers=headers)
+                return PooledResponse(self, key, connection, connection.getresponse())
+            except (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected):
+                connection.close()
+
+                if not reused:
+                    raise
+
+                # the server closed the idle connection in the meantime, try again with a new one
+                connection, reused = self.new_connection(key), False
+            except Exception:
+                connection.close()
+                raise
+
+    def uses_proxy(self, url):
+        # whether a proxy from the environment applies to this url. The `no` entry is the no_proxy list, not a scheme
+        parts = urlparse(url)
+        return parts.scheme in self.proxies and not urllib.request.proxy_bypass(parts.hostname or '')
+
+    def open(self, url, headers=None, method=None):
+        method = method or 'GET'
+
+        for _ in range(self.max_redirects + 1):
+            if self.uses_proxy(url):
+                # connections are only kept alive to the servers we connect to directly, urllib handles proxies
+                return self.proxy_transport.open(url, headers=headers, method=method)
+
+            response = self.request(url, headers, method)
+
+            if response.status in self.redirect_codes and response.getheader('Location'):
+                response.read()
+                response.close()
+                url = urljoin(url, response.getheader('Location'))
+                method = 'GET' if response.status == 303 else method
+                continue
+
+            if response.status >= 400:
+                response.read(64 * 1024)
+                response.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+            return response
+
+        raise urllib.error.URLError('too many redirects for {}'.format(url))
+
+    def close(self):
+        with self._lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+
+            self.idle = {}
+
+
+class InFlightBudget:
+    # caps the total number of bytes being transferred at any given time. A transfer larger than the whole budget is
+    # still allowed, but only when nothing else is in flight
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n):
+        if self.max_bytes is None:
+            return 0
+
+        n = min(n, self.max_bytes)
+
+        with self._cond:
+            while self.in_flight > 0 and self.in_flight + n > self.max_bytes:
+                self._cond.wait()
+
+            self.in_flight += n
+
+        return n
+
+    def release(self, n):
+        if not n:
+            return
+
+        with self._cond:
+            self.in_flight -= n
+            self._cond.notify_all()
+
+
+class PersistentMap:
+    # a dictionary saved as json, at most every save_every seconds and whenever save() is called
+    def __init__(self, path, save_every=30):
+        self.path = path
+        self.save_every = save_every
+        self.entries = {}
+        self.dirty = False
+        self.last_save = time.monotonic()
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                warnings.warn('Ignoring corrupted file {}'.format(path))
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.entries.get(key, default)
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+            self.dirty = True
+            save = time.monotonic() - self.last_save > self.save_every
+
+        if save:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+
+            Path(os.path.dirname(self.path)).mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path + '.tmp'
+
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+            self.last_save = time.monotonic()
+
+
+class VerificationCache(PersistentMap):
+    # persistent map from a file path to the md5 checksum of its content. An entry is trusted only as long as the
+    # file's size, modification time and inode did not change, so that unchanged files do not need to be hashed again
+    @staticmethod
+    def signature(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, path, default=None):
+        path = os.path.abspath(path)
+        entry = super().get(path)
+
+        if entry is None or not os.path.exists(path) or entry[:3] != self.signature(path):
+            return default
+
+        return entry[3]
+
+    def put(self, path, md5):
+        path = os.path.abspath(path)
+        super().put(path, self.signature(path) + [md5])
+
+
+class Journal:
+    # the state of each job of a download (fetching, fetched, done or failed) in a SQLite database, updated as jobs go
+    # through the pipeline
+    def __init__(self, path):
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (remote_key TEXT PRIMARY KEY, output_path TEXT, '
+                                'state TEXT, attempts INTEGER, error TEXT, updated REAL)')
+        self._lock = threading.Lock()
+
+    def state(self, job):
+        with self._lock:
+            row = self.connection.execute('SELECT state FROM jobs WHERE remote_key = ?', (job.remote_key,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def set(self, job, state, error=None):
+        attempt = 1 if state == 'fetching' else 0
+
+        with self._lock:
+            updated = self.connection.execute(
+                'UPDATE jobs SET output_path = ?, state = ?, attempts = attempts + ?, error = ?, updated = ? '
+                'WHERE remote_key = ?', (job.output_path, state, attempt, error, time.time(), job.remote_key))
+
+            if not updated.rowcount:
+                self.connection.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                                        (job.remote_key, job.output_path, state, attempt, error, time.time()))
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+class Manifest:
+    # every video of the dataset, sorted by video id, with the splits it belongs to as a bitmask over split_names.
+    # Selecting videos is a single pass with set and bitmask checks instead of a scan of the per-split video lists, and
+    # the jobs of the selected videos are generated from them, so only the files that are needed are ever listed
+    def __init__(self, split_names, videos):
+        self.split_names = split_names
+        self.videos = videos  # (video dict, split mask) pairs
+        self.video_masks = {v['video_id']: mask for v, mask in videos}
+
+    def split_mask(self, split_names):
+        mask = 0
+
+        for name in split_names:
+            mask |= 1 << self.split_names.index(name)
+
+        return mask
+
+    def select(self, split_mask, participants=None, video_ids=None, extension_only=False, epic55_only=False):
+        # returns the selected video dicts by video id. participants (numerical IDs) and video_ids are sets or None for
+        # all. When both are given, a video is selected if it matches either of them
+        selected = {}
+
+        for v, mask in self.videos:
+            if not mask & split_mask:
+                continue
+
+            if (extension_only and not v['extension']) or (epic55_only and v['extension']):
+                continue
+
+            if participants is None and video_ids is None:
+                selected[v['video_id']] = v
+            elif (participants is not None and v['participant'] in participants) or \
+                    (video_ids is not None and v['video_id'] in video_ids):
+                selected[v['video_id']] = v
+
+        return selected
+
+
+class EpicDownloader:
+    manifest_what = ('videos', 'rgb_frames', 'flow_frames', 'object_detection_images', 'metadata', 'masks')
+    extractable_what = ('rgb_frames', 'flow_frames')
+    large_what = ('videos', 'rgb_frames', 'flow_frames', 'object_detection_images')
+    # rough average file sizes, used to balance shards when the actual sizes are not known
+    expected_sizes = {'videos': 1500 * 1024 ** 2, 'rgb_frames': 2500 * 1024 ** 2, 'flow_frames': 1200 * 1024 ** 2,
+                      'object_detection_images': 300 * 1024 ** 2, 'metadata': 1024 ** 2, 'masks': 30 * 1024 ** 2,
+                      'consent_forms': 200 * 1024}
+    extracted_marker = '.extracted_md5'
+
+
+    def __init__(self,
+                 epic_55_base_url='https://data.bris.ac.uk/datasets/3h91syskeag572hl6tvuovwv4d',
+                 epic_100_base_url='https://data.bris.ac.uk/datasets/2g1n6qdydwa9u22shpxqzp0t8m',
+                 masks_base_url='https://data.bris.ac.uk/datasets/3l8eci2oqgst92n14w2yqi5ytu',
+                 base_output=str(Path.home()),
+                 splits_path_epic_55='data/epic_55_splits.csv',
+                 splits_path_epic_100='data/epic_100_splits.csv',
+                 md5_path='data/md5.csv',
+                 errata_path='data/errata.csv',
+                 errata_only=False,
+                 workers=1,
+                 max_connections_per_host=4,
+                 max_inflight_bytes=None,
+                 segments=1,
+                 segment_threshold=1024 ** 3,
+                 reverify=False,
+                 max_retries=3,
+                 retry_backoff=5,
+                 hash_workers=None,
+                 timeout=60,
+                 pool_size=None,
+                 transport=None,
+                 extract=False,
+                 shard=None,
+                 shard_sizes_path=None,
+                 rate_limiter=None,
+                 metrics=None,
+                 mirrors=None,
+                 populate_mirror=False,
+                 index_frames=False):
+        self.base_url_55 = epic_55_base_url.rstrip('/')
+        self.base_url_100 = epic_100_base_url.rstrip('/')
+        self.base_url_masks = masks_base_url.rstrip('/')
+        self.base_output = os.path.join(base_output, 'EPIC-KITCHENS')
+        self.videos_per_split = {}
+        self.challenges_splits = []
+        self.md5 = {'55': {}, '100': {}, 'errata': {}}
+        self.errata = {}
+        self.manifest = None
+        self.load_manifest(splits_path_epic_55, splits_path_epic_100, md5_path, errata_path)
+        self.errata_only = errata_only
+        self.workers = max(1, workers)
+        self.max_connections_per_host = max(1, max_connections_per_host)
+        self.inflight_budget = InFlightBudget(max_inflight_bytes)
+        self.segments = max(1, segments)
+        self.segment_threshold = segment_threshold
+        self.reverify = reverify
+        self.max_retries = max(0, max_retries)
+        self.retry_backoff = retry_backoff
+        self.failed_downloads = []
+        self.hash_workers = hash_workers or os.cpu_count() or 1
+        self.extract = extract
+        self.rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
+        self.metrics = Metrics() if metrics is None else metrics
+        self.mirrors = list(mirrors or [])
+        self.populate_mirror = populate_mirror
+        self.index_frames = index_frames
+        self.journal = None
+        self.stopping = threading.Event()
+        self.shard = shard
+        self.shard_sizes = {}
+
+        if shard_sizes_path is not None:
+            with open(shard_sizes_path) as f:
+                self.shard_sizes = json.load(f)
+
+        if transport is None:
+            transport = ConnectionPool(size=pool_size or self.max_connections_per_host, timeout=timeout)
+
+        self.transport = transport
+        self.verification_cache = VerificationCache(os.path.join(self.base_output, '.verified_md5.json'))
+        self.remote_sizes = PersistentMap(os.path.join(self.base_output, '.remote_sizes.json'))
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._print_lock = threading.Lock()
+        self._announced_what = None
+
+    def load_manifest(self, splits_path_epic_55, splits_path_epic_100, md5_path, errata_path):
+        # parsing the csv files is quicker than loading any cache of them would be
+        self.parse_splits(splits_path_epic_55, splits_path_epic_100)
+        self.load_md5(md5_path)
+        self.load_errata(errata_path)
+        split_bits = {split: 1 << i for i, split in enumerate(self.challenges_splits)}
+        videos = [(v, sum(split_bits[split] for split in splits)) for v, splits in self.video_splits()]
+        self.manifest = Manifest(self.challenges_splits, videos)
+
+    def video_splits(self):
+        # yields each video dict once, sorted by video id, with the list of splits it belongs to
+        splits_per_video = {}
+        videos = {}
+
+        for split in self.challenges_splits:
+            for v in self.videos_per_split[split]:
+                videos[v['video_id']] = v
+                splits_per_video.setdefault(v['video_id'], []).append(split)
+
+        for video_id in sorted(videos):
+            yield videos[video_id], splits_per_video[video_id]
+
+    def load_errata(self, path):
+        with open(path) as csvfile:
+            reader = csv.DictReader(csvfile, delimiter=',')
+
+            for row in reader:
+                self.errata[row['rdsf_path']] = row['dropbox_path']
+
+    def load_md5(self, path):
+        # a plain reader, building a dict for every row is what makes DictReader slow
+        with open(path) as csvfile:
+            reader = csv.reader(csvfile, delimiter=',')
+            header = next(reader)
+            md5, remote_path, version = (header.index(c) for c in ('md5', 'file_remote_path', 'version'))
+
+            for row in reader:
+                self.md5[row[version]][row[remote_path]] = row[md5]
+
+    def log(self, msg):
+        # a single print under a lock, so that messages coming from concurrent workers do not interleave
+        with self._print_lock:
+            print(msg, flush=True)
+
+    def host_slot(self, url):
+        host = urlparse(url).netloc
+
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+
+            return self._host_slots[host]
+
+    def open_url(self, url, headers=None, method=None):
+        return self.transport.open(url, headers=headers, method=method)
+
+    def remote_info(self, url):
+        # returns the remote file size (None when unknown) and whether the server accepts Range requests
+        try:
+            with self.open_url(url, method='HEAD') as response:
+                length = response.getheader('Content-Length')
+                accepts_ranges = response.getheader('Accept-Ranges', '').lower() == 'bytes'
+                return (int(length) if length is not None else None), accepts_ranges
+        except (OSError, http.client.HTTPException, ValueError):
+            return None, False
+
+    @staticmethod
+    def content_range_start(response):
+        content_range = response.getheader('Content-Range', '')  # e.g. bytes 1000-4999/5000
+
+        try:
+            return int(content_range.split()[1].split('-')[0])
+        except (IndexError, ValueError):
+            return None
+
+    def open_resumable(self, url, part_path):
+        # returns the response and the offset the response body starts from. We try to resume from the end of an
+        # existing .part file and start over whenever the server does not honour the Range request
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+        if offset:
+            try:
+                response = self.open_url(url, headers={'Range': 'bytes={}-'.format(offset)})
+            except urllib.error.HTTPError as e:
+                if e.code != 416:  # 416 means the .part file is not a prefix of the remote file
+                    raise
+            else:
+                if response.status == 206 and self.content_range_start(response) == offset:
+                    return response, offset
+
+                if response.status == 200:  # Range was ignored, the whole file is coming
+                    return response, 0
+
+                response.close()
+
+        return self.open_url(url), 0
+
+    def download_file(self, url, output_path, expected_md5=None, verify=True, first_attempt=0, size=None, large=True):
+        return self.with_retries(self.try_download_file, url, output_path, expected_md5, verify, size, large,
+                                 first_attempt=first_attempt)
+
+    def with_retries(self, func, url, output_path, *args, first_attempt=0):
+        # retries failed and corrupted downloads with an exponential backoff. Returns what func returned, or False when
+        # the file could not be downloaded
+        for attempt in range(first_attempt, self.max_retries + 1):
+            transfer = self.metrics.start_transfer(url, output_path, attempt)
+
+            try:
+                result = func(url, output_path, *args, transfer=transfer)
+                self.metrics.finish_transfer(transfer, verified=result is True)
+                return result
+            except DownloadStopped as e:
+                self.metrics.finish_transfer(transfer, error=e)
+                raise
+            except Exception as e:
+                self.log('Could not download file from {}\nError: {}'.format(url, str(e)))
+                will_retry = attempt < self.max_retries and is_retryable(e)
+                self.metrics.finish_transfer(transfer, error=e, will_retry=will_retry)
+
+                if not will_retry:
+                    self.failed_downloads.append((output_path, url, str(e)))
+                    return False
+
+                delay = self.retry_backoff * 2 ** attempt
+                self.log('Trying again in {} seconds ({}/{})'.format(delay, attempt + 1, self.max_retries))
+
+                if self.stopping.wait(delay):
+                    raise DownloadStopped(url)
+
+    def download_extracted(self, url, output_dir, expected_md5=None):
+        return self.with_retries(self.try_download_extracted, url, output_dir, expected_md5)
+
+    def try_download_extracted(self, url, output_dir, expected_md5=None, transfer=None):
+        # pipes the archive straight into tarfile, so that members are written to disk as the data arrives and the
+        # archive itself is never stored. Members are extracted to a temporary folder which replaces output_dir once
+        # the archive's md5 checksum has been verified
+        partial_dir = output_dir + '.partial'
+
+        if os.path.exists(partial_dir):
+            shutil.rmtree(partial_dir)
+
+        Path(partial_dir).mkdir(parents=True)
+        # the data filter (Python 3.12+, backported to some earlier versions) rejects unsafe members
+        extract_kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+        with self.host_slot(url), self.open_url(url) as response:
+            self.log('Downloading and extracting\nfrom  {}\nto    {}'.format(url, output_dir))
+            reader = HashingReader(response, hashlib.md5(), on_read=lambda n: self.transferred(transfer, n))
+
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                for member in tar:
+                    if not extract_kwargs and not is_safe_member(member):
+                        raise tarfile.TarError('unsafe member {} in {}'.format(member.name, url))
+
+                    tar.extract(member, partial_dir, **extract_kwargs)
+
+            while reader.read(COPY_BUFSIZE):  # the padding after the end of the archive is part of the checksum
+                pass
+
+            expected = response.getheader('Content-Length')
+
+        if expected is not None and reader.bytes_read != int(expected):
+            raise IOError('transfer interrupted after {} of {} bytes'.format(reader.bytes_read, expected))
+
+        md5 = reader.hash_md5.hexdigest()
+
+        if expected_md5 is not None and md5 != expected_md5:
+            shutil.rmtree(partial_dir)
+            raise ChecksumMismatch('checksum mismatch for {}'.format(url))
+
+        with open(os.path.join(partial_dir, self.extracted_marker), 'w') as f:
+            f.write(md5)
+
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+
+        os.replace(partial_dir, output_dir)
+        return True
+
+    def extraction_dir(self, job):
+        return os.path.splitext(job.output_path)[0]
+
+    def extracted_md5(self, job):
+        # the checksum of the archive extracted to the job's folder, None if it has not been (fully) extracted
+        marker_path = os.path.join(self.extraction_dir(job), self.extracted_marker)
+
+        if not os.path.exists(marker_path):
+            return None
+
+        with open(marker_path) as f:
+            return f.read().strip()
+
+    def extracts(self, job):
+        return self.extract and job.what in self.extractable_what
+
+    def try_download_file(self, url, output_path, expected_md5=None, verify=True, size=None, large=True,
+                          transfer=None):
+        # returns True once the file is downloaded and verified. With verify=False, the download is left in its .part
+        # file for verify_part and (part_path, md5) is returned, md5 being None when it was not computed on the fly.
+        # size is the remote size when it is already known. Small files (large=False) are never segmented, so the
+        # HEAD request is only sent for large files that could be segmented or whose size is needed for the budget
+        Path(os.path.dirname(output_path)).mkdir(parents=True, exist_ok=True)
+        part_path = output_path + '.part'
+        accepts_ranges = False
+        reserved = 0
+
+        try:
+            may_segment = large and self.segments > 1 and (size is None or size >= self.segment_threshold)
+
+            if may_segment or (large and size is None and self.inflight_budget.max_bytes is not None):
+                with self.host_slot(url):
+                    size, accepts_ranges = self.remote_info(url)
+
+            reserved = self.inflight_budget.acquire(size or 0)
+            # a .part file without a segments state was written sequentially, so we resume it as a single stream
+            sequential_part = os.path.exists(part_path) and not os.path.exists(part_path + '.segments')
+            segmented = (self.segments > 1 and accepts_ranges and size is not None and
+                         size >= self.segment_threshold and not sequential_part)
+
+            if segmented:
+                try:
+                    return self.download_segmented(url, output_path, size, expected_md5, transfer, verify)
+                except RangeNotSupported:
+                    self.log('The server does not support ranges, downloading as a single stream: {}'.format(url))
+                    self.remove_part(part_path)
+
+            return self.download_stream(url, output_path, expected_md5, transfer, verify)
+        finally:
+            self.inflight_budget.release(reserved)
+
+    def download_stream(self, url, output_path, expected_md5=None, transfer=None, verify=True):
+        # the md5 checksum is computed while the data is written to disk, so that verifying a new download does not
+        # require reading it again. Only a resumed download needs to hash the part downloaded before
+        part_path = output_path + '.part'
+
+        with self.host_slot(url):
+            response, offset = self.open_resumable(url, part_path)
+            # archives are indexed on the fly, unless we resume them. Those are indexed once downloaded
+            indexer = TarIndexer() if self.indexes(output_path) and not offset else None
+
+            if os.path.exists(part_path + '.idx'):
+                os.remove(part_path + '.idx')
+
+            with response, open(part_path, 'ab' if offset else 'wb') as output_file:
+                if offset:
+                    self.log('Resuming download from byte {}\nfrom  {}\nto    {}'.format(offset, url, output_path))
+                    hash_md5 = self.timed_hash_file(part_path)
+                else:
+                    self.log('Downloading\nfrom  {}\nto    {}'.format(url, output_path))
+                    hash_md5 = hashlib.md5()
+
+                self.copy_stream(response, output_file, hash_md5, transfer, indexer)
+                expected = response.getheader('Content-Length')
+                received = output_file.tell() - offset
+
+        if expected is not None and received != int(expected):
+            raise IOError('transfer interrupted after {} of {} bytes'.format(received, expected))
+
+        if indexer is not None and indexer.complete:
+            write_frame_index(part_path + '.idx', indexer.entries, offset + received)
+
+        if not verify:
+            return part_path, hash_md5.hexdigest()
+
+        self.verify_part(url, output_path, hash_md5.hexdigest(), expected_md5)
+        return True
+
+    def verify_part(self, url, output_path, md5, expected_md5=None):
+        # checks a complete .part file against the expected checksum, hashing it when md5 is None, and moves it to
+        # output_path
+        part_path = output_path + '.part'
+
+        if expected_md5 is not None:
+            md5 = self.timed_hash_file(part_path).hexdigest() if md5 is None else md5
+
+            if md5 != expected_md5:
+                self.remove_part(part_path)
+                raise ChecksumMismatch('checksum mismatch for {}'.format(url))
+
+        os.replace(part_path, output_path)
 
+        if os.path.exists(part_path + '.idx'):
+            os.replace(part_path + '.idx', output_path + '.idx')
+        elif os.path.exists(output_path + '.idx'):
+            os.remove(output_path + '.idx')  # the index of a previous version of the file
 
-class EpicDownloader:
-    def __init__(self,
-                 epic_55_base_url='https://data.bris.ac.uk/datasets/3h91syskeag572hl6tvuovwv4d',
-                 epic_100_base_url='https://data.bris.ac.uk/datasets/2g1n6qdydwa9u22shpxqzp0t8m',
-                 masks_base_url='https://data.bris.ac.uk/datasets/3l8eci2oqgst92n14w2yqi5ytu',
-                 base_output=str(Path.home()),
-                 splits_path_epic_55='data/epic_55_splits.csv',
-                 splits_path_epic_100='data/epic_100_splits.csv',
-                 md5_path='data/md5.csv',
-                 errata_path='data/errata.csv',
-                 errata_only=False):
-        self.base_url_55 = epic_55_base_url.rstrip('/')
-        self.base_url_100 = epic_100_base_url.rstrip('/')
-        self.base_url_masks = masks_base_url.rstrip('/')
-        self.base_output = os.path.join(base_output, 'EPIC-KITCHENS')
-        self.videos_per_split = {}
-        self.challenges_splits = []
-        self.md5 = {'55': {}, '100': {}, 'errata': {}}
-        self.errata = {}
-        self.parse_splits(splits_path_epic_55, splits_path_epic_100)
-        self.load_md5(md5_path)
-        self.load_errata(errata_path)
-        self.errata_only = errata_only
+        if os.path.exists(part_path + '.segments'):
+            os.remove(part_path + '.segments')
 
-    def load_errata(self, path):
-        with open(path) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',')
+        if expected_md5 is not None:
+            self.verification_cache.put(output_path, expected_md5)
 
-            for row in reader:
-                self.errata[row['rdsf_path']] = row['dropbox_path']
+    def copy_stream(self, response, output_file, hash_md5, transfer, indexer=None):
+        buffer = bytearray(COPY_BUFSIZE)
+        view = memoryview(buffer)
 
-    def load_md5(self, path):
-        with open(path) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',')
+        while True:
+            n = response.readinto(buffer)
 
-            for row in reader:
-                v = row['version']
-                self.md5[v][row['file_remote_path']] = row['md5']
+            if not n:
+                break
+
+            self.transferred(transfer, n)
+            output_file.write(view[:n])
+            hash_md5.update(view[:n])
+
+            if indexer is not None:
+                indexer.feed(view[:n])
+
+    def transferred(self, transfer, n):
+        # called for every chunk received, before it is written. Stopping leaves the .part file as it is, so that the
+        # download resumes from there on the next run
+        if self.stopping.is_set():
+            raise DownloadStopped(transfer.url)
+
+        self.rate_limiter.consume(transfer.host, n)
+        self.metrics.transferred(transfer, n)
 
     @staticmethod
-    def download_file(url, output_path):
-        Path(os.path.dirname(output_path)).mkdir(parents=True, exist_ok=True)
+    def remove_part(part_path):
+        for path in (part_path, part_path + '.segments', part_path + '.idx'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def download_segmented(self, url, output_path, size, expected_md5=None, transfer=None, verify=True):
+        # splits the file in byte ranges fetched in parallel straight into their offset of a preallocated .part file.
+        # Completed segments are recorded in a .segments file next to it, so an interrupted download only fetches the
+        # missing ones on the next run
+        part_path = output_path + '.part'
+        state_path = part_path + '.segments'
+        bounds = [(size * i // self.segments, size * (i + 1) // self.segments - 1) for i in range(self.segments)]
+        state = {'size': size, 'segments': self.segments, 'done': []}
+
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                previous = json.load(f)
+
+            if previous['size'] == size and previous['segments'] == self.segments:
+                state = previous
+
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0))
 
         try:
-            with urllib.request.urlopen(url) as response, open(output_path, 'wb') as output_file:
-                print('Downloading\nfrom  {}\nto    {}'.format(url, output_path))
-                shutil.copyfileobj(response, output_file)
-        except Exception as e:
-            print('Could not download file from {}\nError: {}'.format(url, str(e)))
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+
+        missing = [i for i in range(self.segments) if i not in state['done']]
+        self.log('Downloading in {} segments ({} left)\nfrom  {}\nto    {}'.format(self.segments, len(missing), url,
+                                                                                  output_path))
+        state_lock = threading.Lock()
+
+        def fetch(i):
+            self.download_segment(url, part_path, bounds[i][0], bounds[i][1], transfer)
+
+            with state_lock:
+                state['done'].append(i)
+
+                with open(state_path, 'w') as f:
+                    json.dump(state, f)
+
+        with ThreadPoolExecutor(max_workers=self.segments) as pool:
+            futures = [pool.submit(fetch, i) for i in missing]
+            errors = [f.exception() for f in futures if f.exception() is not None]
+
+        if errors:
+            raise next((e for e in errors if isinstance(e, RangeNotSupported)), errors[0])
+
+        if not verify:
+            return part_path, None
+
+        self.verify_part(url, output_path, None, expected_md5)
+        return True
+
+    def download_segment(self, url, part_path, start, end, transfer):
+        with self.host_slot(url):
+            try:
+                response = self.open_url(url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+            except urllib.error.HTTPError as e:
+                if e.code == 416:  # the range is within the size the server gave us, so it rejects ranges
+                    raise RangeNotSupported(url)
+
+                raise
+
+            with response:
+                if response.status != 206 or self.content_range_start(response) != start:
+                    raise RangeNotSupported(url)
+
+                fd = os.open(part_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+                position = start
+
+                try:
+                    for chunk in iter(lambda: response.read(COPY_BUFSIZE), b''):
+                        self.transferred(transfer, len(chunk))
+                        pwrite(fd, chunk, position)
+                        position += len(chunk)
+                finally:
+                    os.close(fd)
+
+        if position != end + 1:
+            raise IOError('segment {}-{} of {} interrupted at byte {}'.format(start, end, url, position))
 
     @staticmethod
     def parse_bool(b):
         return b.lower().strip() in ['true', 'yes', 'y']
     
     @staticmethod
-    def md5_checksum(path):
-        hash_md5 = hashlib.md5()
+    def hash_file(path, hash_md5=None):
+        # reads the file straight into a large per-thread buffer, which keeps hashing bound by the disk rather than by
+        # the overhead of many small reads
+        hash_md5 = hashlib.md5() if hash_md5 is None else hash_md5
+
+        if getattr(_hash_buffers, 'buffer', None) is None:
+            _hash_buffers.buffer = bytearray(HASH_BUFSIZE)
 
-        with open(path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
+        buffer = _hash_buffers.buffer
+        view = memoryview(buffer)
 
-        return hash_md5.hexdigest()
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            for n in iter(lambda: f.readinto(buffer), 0):
+                hash_md5.update(view[:n])
+
+        return hash_md5
+
+    @staticmethod
+    def md5_checksum(path):
+        return EpicDownloader.hash_file(path).hexdigest()
+
+    def timed_hash_file(self, path):
+        start = time.monotonic()
+        hash_md5 = self.hash_file(path)
+        self.metrics.hashed(path, os.path.getsize(path), time.monotonic() - start)
+        return hash_md5
 
     def parse_splits(self, epic_55_splits_path, epic_100_splits_path):
         epic_55_videos = {}
@@ -98,14 +1667,17 @@ class EpicDownloader:
                 epic_55_videos[row['video_id']] = row['split']
 
         with open(epic_100_splits_path) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',')
-            self.challenges_splits = [f for f in reader.fieldnames if f != 'video_id']
+            reader = csv.reader(csvfile, delimiter=',')
+            header = next(reader)
+            video_id_column = header.index('video_id')
+            self.challenges_splits = [f for f in header if f != 'video_id']
+            split_columns = [(split, header.index(split)) for split in self.challenges_splits]
 
             for f in self.challenges_splits:
                 self.videos_per_split[f] = []
 
             for row in reader:
-                video_id = row['video_id']
+                video_id = row[video_id_column]
                 parts = video_id.split('_')
                 participant = int(parts[0].split('P')[1])
                 extension = len(parts[1]) == 3
@@ -113,32 +1685,32 @@ class EpicDownloader:
                 v = {'video_id': video_id, 'participant': participant, 'participant_str': parts[0],
                      'extension': extension, 'epic_55_split': epic_55_split}
 
-                for split in self.challenges_splits:
-                    if self.parse_bool(row[split]):
+                for split, column in split_columns:
+                    if self.parse_bool(row[column]):
                         self.videos_per_split[split].append(v)
 
-    def download_consent_forms(self, video_dicts):
+    def consent_forms_jobs(self, video_dicts):
         files_55 = ['ConsentForm.pdf', 'ParticipantsInformationSheet.pdf']
 
         for f in files_55:
             output_path = os.path.join(self.base_output, 'ConsentForms', 'EPIC-55-{}'.format(f))
             url = '/'.join([self.base_url_55, 'ConsentForms', f])
-            self.download_file(url, output_path)
+            yield DownloadJob(url, output_path, 'ConsentForms/{}'.format(f), '55')
 
         output_path = os.path.join(self.base_output, 'ConsentForms', 'EPIC-100-ConsentForm.pdf')
         url = '/'.join([self.base_url_100, 'ConsentForms', 'consent-form.pdf'])
-        self.download_file(url, output_path)
+        yield DownloadJob(url, output_path, 'ConsentForms/consent-form.pdf', '100')
 
-    def download_videos(self, video_dicts, file_ext='MP4'):
+    def videos_jobs(self, video_dicts, file_ext='MP4'):
         def epic_55_parts(d):
             return ['videos', d['epic_55_split'], d['participant_str'], '{}.{}'.format(d['video_id'], file_ext)]
 
         def epic_100_parts(d):
             return [d['participant_str'], 'videos', '{}.{}'.format(d['video_id'], file_ext)]
 
-        self.download_items(video_dicts, epic_55_parts, epic_100_parts)
+        return self.item_jobs(video_dicts, epic_55_parts, epic_100_parts)
 
-    def download_rgb_frames(self, video_dicts, file_ext='tar'):
+    def rgb_frames_jobs(self, video_dicts, file_ext='tar'):
         def epic_55_parts(d):
             return ['frames_rgb_flow', 'rgb', d['epic_55_split'], d['participant_str'],
                     '{}.{}'.format(d['video_id'], file_ext)]
@@ -146,9 +1718,9 @@ class EpicDownloader:
         def epic_100_parts(d):
             return [d['participant_str'], 'rgb_frames', '{}.{}'.format(d['video_id'], file_ext)]
 
-        self.download_items(video_dicts, epic_55_parts, epic_100_parts)
+        return self.item_jobs(video_dicts, epic_55_parts, epic_100_parts)
 
-    def download_flow_frames(self, video_dicts, file_ext='tar'):
+    def flow_frames_jobs(self, video_dicts, file_ext='tar'):
         def epic_55_parts(d):
             return ['frames_rgb_flow', 'flow', d['epic_55_split'], d['participant_str'],
                     '{}.{}'.format(d['video_id'], file_ext)]
@@ -156,9 +1728,9 @@ class EpicDownloader:
         def epic_100_parts(d):
             return [d['participant_str'], 'flow_frames', '{}.{}'.format(d['video_id'], file_ext)]
 
-        self.download_items(video_dicts, epic_55_parts, epic_100_parts)
+        return self.item_jobs(video_dicts, epic_55_parts, epic_100_parts)
 
-    def download_object_detection_images(self, video_dicts, file_ext='tar'):
+    def object_detection_images_jobs(self, video_dicts, file_ext='tar'):
         # these are available for epic 55 only, but we will use the epic_100_parts func to create a consistent output
         # path
         epic_55_dicts = {k: v for k, v in video_dicts.items() if not v['extension']}
@@ -170,9 +1742,9 @@ class EpicDownloader:
         def epic_100_parts(d):
             return [d['participant_str'], 'object_detection_images', '{}.{}'.format(d['video_id'], file_ext)]
 
-        self.download_items(epic_55_dicts, epic_55_parts, epic_100_parts)
+        return self.item_jobs(epic_55_dicts, epic_55_parts, epic_100_parts)
 
-    def download_metadata(self, video_dicts, file_ext='csv'):
+    def metadata_jobs(self, video_dicts, file_ext='csv'):
         epic_100_dicts = {k: v for k, v in video_dicts.items() if v['extension']}
 
         def epic_100_accl_parts(d):
@@ -181,10 +1753,10 @@ class EpicDownloader:
         def epic_100_gyro_parts(d):
             return [d['participant_str'], 'meta_data', '{}-gyro.{}'.format(d['video_id'], file_ext)]
 
-        self.download_items(epic_100_dicts, None, epic_100_accl_parts)
-        self.download_items(epic_100_dicts, None, epic_100_gyro_parts)
+        yield from self.item_jobs(epic_100_dicts, None, epic_100_accl_parts)
+        yield from self.item_jobs(epic_100_dicts, None, epic_100_gyro_parts)
 
-    def download_masks(self, video_dicts, file_ext='pkl'):
+    def masks_jobs(self, video_dicts, file_ext='pkl'):
         def remote_object_hands_parts(d):
             return ['hand-objects', d['participant_str'], '{}.{}'.format(d['video_id'], file_ext)]
 
@@ -198,40 +1770,445 @@ class EpicDownloader:
             return [d['participant_str'], 'masks', '{}.{}'.format(d['video_id'], file_ext)]
 
         # data is organised in the same way for both epic-55 and the extension so we pass the same functions
-        self.download_items(video_dicts, remote_object_hands_parts, remote_object_hands_parts,
-                            from_url=self.base_url_masks, output_parts=output_object_hands_parts)
-        self.download_items(video_dicts, remote_masks_parts, remote_masks_parts,
-                            from_url=self.base_url_masks, output_parts=output_masks_parts)
+        yield from self.item_jobs(video_dicts, remote_object_hands_parts, remote_object_hands_parts,
+                                  from_url=self.base_url_masks, output_parts=output_object_hands_parts)
+        yield from self.item_jobs(video_dicts, remote_masks_parts, remote_masks_parts,
+                                  from_url=self.base_url_masks, output_parts=output_masks_parts)
+
+    def jobs(self, what, video_dicts, **kwargs):
+        for job in getattr(self, '{}_jobs'.format(what))(video_dicts, **kwargs):
+            job.what = what
+            yield job
+
+    def plan(self, what=('videos', 'rgb_frames', 'flow_frames'), participants='all', specific_videos='all',
+             splits='all', challenges='all', extension_only=False, epic55_only=False, write_manifest=True):
+        # the jobs for the selected files, in the same order they are downloaded. When sharding, only the jobs
+        # assigned to this shard, whose manifest is written unless write_manifest is False (e.g. for dry runs)
+        jobs = self.selected_jobs(what, participants=participants, specific_videos=specific_videos, splits=splits,
+                                  challenges=challenges, extension_only=extension_only, epic55_only=epic55_only)
+
+        if self.shard is None:
+            return jobs
+
+        return iter(self.shard_jobs(list(jobs), *self.shard, write_manifest=write_manifest))
+
+    def selected_jobs(self, what, participants='all', specific_videos='all', splits='all', challenges='all',
+                      extension_only=False, epic55_only=False):
+        # looks up the selected files in the manifest
+        split_mask = self.manifest.split_mask(self.selected_splits(splits, challenges))
+        participant_ids = None if participants == 'all' else {p if type(p) == int else int(p[1:])
+                                                               for p in participants}
+        video_ids = None if specific_videos == 'all' else set(specific_videos)
+        video_dicts = self.manifest.select(split_mask, participant_ids, video_ids, extension_only, epic55_only)
+
+        for w in what:
+            jobs = self.jobs(w, video_dicts if w in self.manifest_what else {})
+
+            for job in jobs:
+                if job.version == 'errata' or not self.errata_only:
+                    yield job
+
+    def expected_size(self, job):
+        # only sizes that are the same for every node can be used here, i.e. not the sizes recorded locally
+        size = self.shard_sizes.get(job.remote_key)
+        return self.expected_sizes.get(job.what, 0) if size is None else size
+
+    def shard_jobs(self, jobs, index, count, write_manifest=True):
+        # deterministically assigns jobs to `count` shards balancing their expected size: the largest jobs are assigned
+        # first, each to the shard with the smallest total so far. The jobs of this shard are written to a manifest so
+        # that a coordinator can check that all shards together cover the selection (see check_shard_manifests)
+        loads = [(0, i) for i in range(count)]
+        assigned = set()
+
+        for job in sorted(jobs, key=lambda j: (-self.expected_size(j), j.remote_key)):
+            load, i = heapq.heappop(loads)
+
+            if i == index:
+                assigned.add(job.remote_key)
+
+            heapq.heappush(loads, (load + self.expected_size(job), i))
+
+        shard = [job for job in jobs if job.remote_key in assigned]
+        digest = hashlib.sha1('\n'.join(sorted(job.remote_key for job in jobs)).encode()).hexdigest()
+        manifest = {
+            'shard': index,
+            'count': count,
+            'selection_digest': digest,
+            'total_jobs': len(jobs),
+            'total_expected_bytes': sum(self.expected_size(job) for job in jobs),
+            'expected_bytes': sum(self.expected_size(job) for job in shard),
+            'jobs': [{'remote_key': job.remote_key, 'output_path': os.path.relpath(job.output_path, self.base_output),
+                      'expected_bytes': self.expected_size(job)} for job in shard],
+        }
+        message = 'Shard {}/{}: {} of {} files, about {} of {}'.format(
+            index, count, len(shard), len(jobs), format_size(manifest['expected_bytes']),
+            format_size(manifest['total_expected_bytes']))
+
+        if write_manifest:
+            manifest_path = os.path.join(self.base_output, 'shards', 'shard-{}-of-{}.json'.format(index, count))
+            Path(os.path.dirname(manifest_path)).mkdir(parents=True, exist_ok=True)
+
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=1)
+
+            message += '. Manifest written to {}'.format(manifest_path)
+
+        self.log(message)
+
+        return shard
+
+    def download_consent_forms(self, video_dicts):
+        self.run_downloads(self.jobs('consent_forms', video_dicts))
+
+    def download_videos(self, video_dicts, file_ext='MP4'):
+        self.run_downloads(self.jobs('videos', video_dicts, file_ext=file_ext))
+
+    def download_rgb_frames(self, video_dicts, file_ext='tar'):
+        self.run_downloads(self.jobs('rgb_frames', video_dicts, file_ext=file_ext))
+
+    def download_flow_frames(self, video_dicts, file_ext='tar'):
+        self.run_downloads(self.jobs('flow_frames', video_dicts, file_ext=file_ext))
+
+    def download_object_detection_images(self, video_dicts, file_ext='tar'):
+        self.run_downloads(self.jobs('object_detection_images', video_dicts, file_ext=file_ext))
+
+    def download_metadata(self, video_dicts, file_ext='csv'):
+        self.run_downloads(self.jobs('metadata', video_dicts, file_ext=file_ext))
+
+    def download_masks(self, video_dicts, file_ext='pkl'):
+        self.run_downloads(self.jobs('masks', video_dicts, file_ext=file_ext))
 
     def download_items(self, video_dicts, epic_55_parts_func, epic_100_parts_func, from_url=None, output_parts=None):
+        self.run_downloads(self.item_jobs(video_dicts, epic_55_parts_func, epic_100_parts_func, from_url=from_url,
+                                     output_parts=output_parts))
+
+    def item_jobs(self, video_dicts, epic_55_parts_func, epic_100_parts_func, from_url=None, output_parts=None):
+        output_parts = epic_100_parts_func if output_parts is None else output_parts
+
         for video_id, d in video_dicts.items():
             extension = d['extension']
             remote_parts = epic_100_parts_func(d) if extension else epic_55_parts_func(d)
-            erratum_url = self.errata.get('/'.join(remote_parts), None)
+            remote_key = '/'.join(remote_parts)
+            erratum_url = self.errata.get(remote_key, None)
 
             if erratum_url is None:
-                if self.errata_only:
-                    continue
-
                 if from_url is None:
                     base_url = self.base_url_100 if extension else self.base_url_55
                 else:
                     base_url = from_url
 
-                url = '/'.join([base_url] + remote_parts)
+                url = '/'.join([base_url, remote_key])
                 version = '100' if extension else '55'
             else:
-                print_header('~ Going to download an erratum now! ~', char='~')
                 url = erratum_url
                 version = 'errata'
 
-            output_parts = epic_100_parts_func if output_parts is None else output_parts
-            output_path = os.path.join(self.base_output, *output_parts(d))
+            # the parts are plain names, so joining them is the same as (but much quicker than) os.path.join
+            output_path = os.sep.join([self.base_output] + output_parts(d))
 
-            if self.file_already_downloaded(output_path, remote_parts, version):
-                print('This file was already downloaded, skipping it: {}'.format(output_path))
-            else:
-                self.download_file(url, output_path)
+            yield DownloadJob(url, output_path, remote_key, version, video_id=video_id)
+
+    def skip_job(self, job):
+        # whether the job's file was already downloaded (or extracted) and verified
+        expected_md5 = self.md5[job.version].get(job.remote_key)
+        start = time.monotonic()
+
+        if self.extracts(job):
+            extracted_md5 = self.extracted_md5(job)
+
+            if extracted_md5 is not None and extracted_md5 == (expected_md5 or extracted_md5):
+                self.log('This file was already extracted, skipping it: {}'.format(self.extraction_dir(job)))
+                self.metrics.skipped(self.extraction_dir(job), time.monotonic() - start)
+                return True
+        elif self.file_already_downloaded(job.output_path, job.remote_key.split('/'), job.version):
+            self.log('This file was already downloaded, skipping it: {}'.format(job.output_path))
+            self.metrics.skipped(job.output_path, time.monotonic() - start)
+            self.ensure_frame_index(job.output_path)
+            return True
+
+        self.metrics.inc('check_seconds_total', time.monotonic() - start)
+        return False
+
+    def fetch_job(self, job, verify=True):
+        # downloads the job's file or copies it from a mirror. Returns False if that failed and otherwise the result of
+        # download_file, i.e. (part_path, md5) for a download left to verify when verify is False
+        expected_md5 = self.md5[job.version].get(job.remote_key)
+
+        if expected_md5 is not None and not self.extracts(job) and self.copy_from_mirrors(job, expected_md5):
+            self.remote_sizes.put(job.remote_key, os.path.getsize(job.output_path))
+            self.ensure_frame_index(job.output_path)
+            return True
+
+        if job.version == 'errata':
+            with self._print_lock:
+                print_header('~ Going to download an erratum now! ~', char='~')
+
+        if self.extracts(job):
+            return self.download_extracted(job.url, self.extraction_dir(job), expected_md5=expected_md5)
+
+        result = self.download_file(job.url, job.output_path, expected_md5=expected_md5, verify=verify,
+                                    **self.transfer_hints(job))
+
+        if result is True:
+            self.downloaded(job, expected_md5)
+
+        return result
+
+    def transfer_hints(self, job):
+        return {'size': self.remote_sizes.get(job.remote_key), 'large': job.what in self.large_what}
+
+    def downloaded(self, job, expected_md5):
+        self.remote_sizes.put(job.remote_key, os.path.getsize(job.output_path))
+        self.ensure_frame_index(job.output_path)
+
+        if self.populate_mirror and expected_md5 is not None:
+            self.add_to_mirror(job.output_path, expected_md5)
+
+    def indexes(self, path):
+        return self.index_frames and path.endswith('.tar')
+
+    def ensure_frame_index(self, path):
+        # indexes archives whose index could not be built while downloading them, e.g. resumed or segmented downloads
+        if not self.indexes(path):
+            return
+
+        try:
+            read_frame_index(path + '.idx', os.path.getsize(path))
+            return
+        except (OSError, ValueError, struct.error):
+            pass
+
+        try:
+            write_frame_index(path + '.idx', scan_tar(path), os.path.getsize(path))
+        except (OSError, tarfile.TarError) as e:
+            self.log('Could not index {}\nError: {}'.format(path, str(e)))
+
+    @staticmethod
+    def is_url(source):
+        return urlparse(source).scheme in ('http', 'https')
+
+    @staticmethod
+    def mirror_path(mirror, md5):
+        # local mirrors are content addressed, e.g. 92/92e69699627a13611fa26045b3881c93
+        return os.path.join(mirror, md5[:2], md5)
+
+    def copy_from_mirrors(self, job, expected_md5):
+        # tries the mirrors in the given order, returns whether one of them had the file
+        for mirror in self.mirrors:
+            try:
+                if self.is_url(mirror):
+                    found = self.download_from_mirror(mirror, job, expected_md5)
+                else:
+                    found = self.link_from_mirror(mirror, job, expected_md5)
+            except DownloadStopped:
+                raise
+            except Exception as e:
+                self.log('Could not get {} from the mirror {}\nError: {}'.format(job.remote_key, mirror, str(e)))
+                continue
+
+            if found:
+                self.metrics.inc('files_from_mirror_total', mirror=mirror)
+                self.metrics.event('mirror_hit', mirror=mirror, path=job.output_path)
+                return True
+
+        return False
+
+    def link_from_mirror(self, mirror, job, expected_md5):
+        source = self.mirror_path(mirror, expected_md5)
+
+        # files in the mirror are verified once, then trusted for as long as they do not change
+        if not os.path.exists(source) or self.local_md5(source) != expected_md5:
+            return False
+
+        Path(os.path.dirname(job.output_path)).mkdir(parents=True, exist_ok=True)
+        method = clone_file(source, job.output_path)
+        self.log('Copied from the mirror ({})\nfrom  {}\nto    {}'.format(method, source, job.output_path))
+        self.verification_cache.put(job.output_path, expected_md5)
+        return True
+
+    def download_from_mirror(self, mirror, job, expected_md5):
+        # http mirrors serve the same tree as the dataset's servers. The download is verified as usual, but not retried
+        url = '/'.join([mirror.rstrip('/'), job.remote_key])
+        transfer = self.metrics.start_transfer(url, job.output_path, 0)
+
+        try:
+            self.try_download_file(url, job.output_path, expected_md5, transfer=transfer, **self.transfer_hints(job))
+        except Exception as e:
+            self.metrics.finish_transfer(transfer, error=e)
+
+            if isinstance(e, urllib.error.HTTPError) and e.code == 404:
+                return False
+
+            raise
+
+        self.metrics.finish_transfer(transfer)
+        return True
+
+    def add_to_mirror(self, path, md5):
+        # adds a downloaded file to the first local mirror
+        mirror = next((m for m in self.mirrors if not self.is_url(m)), None)
+
+        if mirror is None or os.path.exists(self.mirror_path(mirror, md5)):
+            return
+
+        destination = self.mirror_path(mirror, md5)
+
+        try:
+            Path(os.path.dirname(destination)).mkdir(parents=True, exist_ok=True)
+            clone_file(path, destination)
+            self.verification_cache.put(destination, md5)
+        except OSError as e:
+            self.log('Could not add {} to the mirror {}\nError: {}'.format(path, mirror, str(e)))
+
+    def run_pipeline(self, jobs):
+        # jobs flow from the (lazy) job stream through a fetch stage, which downloads files, and a verify stage, which
+        # checks their checksum, connected by bounded queues. The verification of a file thus overlaps with the download
+        # of the next ones. The state of every job is recorded in the journal, and a file downloaded but not verified
+        # when the process stopped goes straight to the verify stage on the next run
+        fetch_queue = queue.Queue(maxsize=self.workers)
+        verify_queue = queue.Queue(maxsize=self.workers)
+        fetchers = [threading.Thread(target=self.fetch_stage, args=(fetch_queue, verify_queue))
+                    for _ in range(self.workers)]
+        verifiers = [threading.Thread(target=self.verify_stage, args=(verify_queue,))
+                     for _ in range(max(1, min(self.workers, self.hash_workers)))]
+
+        for thread in fetchers + verifiers:
+            thread.start()
+
+        self._announced_what = None
+
+        try:
+            for job in jobs:
+                if job.version != 'errata' and self.errata_only:
+                    continue
+
+                if self.journal.state(job) == 'fetched' and os.path.exists(job.output_path + '.part'):
+                    verify_queue.put((job, None))
+                else:
+                    self.metrics.inc('queue_depth')
+                    fetch_queue.put(job)
+
+            self.join_stages(fetch_queue, fetchers, verify_queue, verifiers)
+        except BaseException:
+            # e.g. Ctrl-C: running downloads stop at their next chunk and queued jobs are dropped. Their journal state
+            # and .part files are left as they are for the next run
+            self.stopping.set()
+            self.log('Stopping, interrupted downloads will resume on the next run')
+            self.metrics.inc('queue_depth', -sum(job is not None for job in self.drain(fetch_queue)))
+            self.drain(verify_queue)
+            self.join_stages(fetch_queue, fetchers, verify_queue, verifiers)
+            raise
+
+    def announce(self, what):
+        # the header of a data type is printed when the first of its files is fetched rather than queued, so that it
+        # does not show up in the middle of the previous data type's files
+        with self._print_lock:
+            if what is not None and what != self._announced_what and not self.errata_only:
+                self._announced_what = what
+                print_header('| Downloading {} now |'.format(' '.join(what.split('_'))), char='-')
+
+    @staticmethod
+    def join_stages(fetch_queue, fetchers, verify_queue, verifiers):
+        for _ in fetchers:
+            fetch_queue.put(None)
+
+        for thread in fetchers:
+            thread.join()
+
+        for _ in verifiers:
+            verify_queue.put(None)
+
+        for thread in verifiers:
+            thread.join()
+
+    @staticmethod
+    def drain(q):
+        # removes and returns the items waiting in a queue
+        items = []
+
+        while True:
+            try:
+                items.append(q.get_nowait())
+            except queue.Empty:
+                return items
+
+    def fetch_stage(self, fetch_queue, verify_queue):
+        # a stage thread must keep consuming its queue whatever happens, otherwise the pipeline would stall
+        for job in iter(fetch_queue.get, None):
+            self.metrics.inc('queue_depth', -1)
+
+            if self.stopping.is_set():
+                continue
+
+            try:
+                self.announce(job.what)
+
+                if self.skip_job(job):
+                    self.journal.set(job, 'done')
+                    continue
+
+                self.journal.set(job, 'fetching')
+                result = self.fetch_job(job, verify=False)
+
+                if result is True or result is False:  # copied from a mirror, extracted or failed
+                    self.journal.set(job, 'done' if result else 'failed')
+                    continue
+
+                self.journal.set(job, 'fetched')
+            except DownloadStopped:
+                continue  # the job stays in the fetching state
+            except Exception as e:
+                self.fail_job(job, e)
+                continue
+
+            verify_queue.put((job, result[1]))
+
+    def verify_stage(self, verify_queue):
+        for job, md5 in iter(verify_queue.get, None):
+            if self.stopping.is_set():
+                continue  # the job stays in the fetched state
+
+            expected_md5 = self.md5[job.version].get(job.remote_key)
+
+            try:
+                try:
+                    self.verify_part(job.url, job.output_path, md5, expected_md5)
+                    self.metrics.inc('files_downloaded_total')
+                    ok = True
+                except ChecksumMismatch as e:
+                    self.metrics.inc('download_failures_total', host=job.host)
+
+                    if not self.max_retries:
+                        raise
+
+                    # first retry of the download, waiting as with_retries would have
+                    self.log('{}, downloading it again in {} seconds (1/{})'.format(e, self.retry_backoff,
+                                                                                     self.max_retries))
+                    self.metrics.inc('retries_total')
+
+                    if self.stopping.wait(self.retry_backoff):
+                        raise DownloadStopped(job.url)
+
+                    ok = self.download_file(job.url, job.output_path, expected_md5=expected_md5, first_attempt=1,
+                                            **self.transfer_hints(job))
+
+                if ok:
+                    self.downloaded(job, expected_md5)
+
+                self.journal.set(job, 'done' if ok else 'failed')
+            except DownloadStopped:
+                pass
+            except Exception as e:
+                self.fail_job(job, e)
+
+    def fail_job(self, job, error):
+        self.log('Could not download file from {}\nError: {}'.format(job.url, str(error)))
+        self.failed_downloads.append((job.output_path, job.url, str(error)))
+
+        try:
+            self.journal.set(job, 'failed', error=str(error))
+        except sqlite3.Error:
+            pass
 
     def file_already_downloaded(self, output_path, parts, version):
         if not os.path.exists(output_path):
@@ -243,52 +2220,32 @@ class EpicDownloader:
         if remote_md5 is None:
             return False
 
-        local_md5 = self.md5_checksum(output_path)  # we already checked file exists so we are safe here
+        local_md5 = self.local_md5(output_path)  # we already checked file exists so we are safe here
         return local_md5 == remote_md5
 
-    def download(self, what=('videos', 'rgb_frames', 'flow_frames'), participants='all', specific_videos='all', splits='all',
-                 challenges='all', extension_only=False, epic55_only=False):
+    def local_md5(self, path):
+        # hashes the file only when the verification cache has no valid entry for it (or we were asked to reverify)
+        md5 = None if self.reverify else self.verification_cache.get(path)
+
+        if md5 is None:
+            md5 = self.timed_hash_file(path).hexdigest()
+            self.verification_cache.put(path, md5)
 
-        video_dicts = {}
+        return md5
 
+    def selected_splits(self, splits='all', challenges='all'):
         if splits == 'all' and challenges == 'all':
-            download_splits = self.challenges_splits
+            return self.challenges_splits
         elif splits == 'all':
-            download_splits = [cs for cs in self.challenges_splits for c in challenges if c == cs.split('_')[0]]
+            return [cs for cs in self.challenges_splits for c in challenges if c == cs.split('_')[0]]
         elif challenges == 'all':
-            download_splits = [cs for cs in self.challenges_splits for s in splits if s in cs.partition('_')[2]]
+            return [cs for cs in self.challenges_splits for s in splits if s in cs.partition('_')[2]]
         else:
-            download_splits = [cs for cs in self.challenges_splits for c in challenges for s in splits
-                               if c == cs.split('_')[0] and s in cs.partition('_')[2]]
-
-        for ds in download_splits:
-            if not extension_only and not epic55_only:
-                vl = self.videos_per_split[ds]
-            else:
-                # we know that only one between extension_only and epic_55_only will be True
-                vl = [v for v in self.videos_per_split[ds] if (extension_only and v['extension']) or
-                                                              (epic55_only and not v['extension'])]
-
-            if participants != 'all' and specific_videos == 'all':
-                if type(participants[0]) == int:
-                    vl = [v for v in vl if v['participant'] in participants]
-                else:
-                    vl = [v for v in vl if v['participant_str'] in participants]
-            if specific_videos != 'all' and participants == 'all':
-                vl = [v for v in vl if v['video_id'] in specific_videos]
-            elif participants != 'all' and specific_videos != 'all':
-                if type(participants[0]) == int:
-                    vp = [v for v in vl if v['participant'] in participants]
-                else:
-                    vp = [v for v in vl if v['participant_str'] in participants]
-                vs = [v for v in vl if v['video_id'] in specific_videos]
-                vl = vp + vs
-
-            video_dicts.update({v['video_id']: v for v in vl})  # We use a dict to avoid duplicates
+            return [cs for cs in self.challenges_splits for c in challenges for s in splits
+                    if c == cs.split('_')[0] and s in cs.partition('_')[2]]
 
-        # sorting the dictionary
-        video_dicts = {k: video_dicts[k] for k in sorted(video_dicts.keys())}
-        
+    def print_selection(self, action, what, participants='all', specific_videos='all', splits='all', challenges='all',
+                        extension_only=False, epic55_only=False):
         if epic55_only:
             source = 'EPIC 55'
         elif extension_only:
@@ -306,19 +2263,234 @@ class EpicDownloader:
         videos_str = 'all' if specific_videos == 'all' else ', '.join([f"{v}" for v in specific_videos])
 
         if not self.errata_only:
-            print('Going to download: {}\n'
+            print('Going to {}: {}\n'
                   'for challenges: {}\n'
                   'splits: {}\n'
                   'participants: {}\n'
                   'specific videos: {}\n'
-                  'data source: {}'.format(what_str, challenges, splits, participants_str, videos_str, source))
-        
-        for w in what:
-            if not self.errata_only:
-                print_header('| Downloading {} now |'.format(' '.join(w.split('_'))), char='-')
+                  'data source: {}'.format(action, what_str, challenges, splits, participants_str, videos_str, source))
+
+    def download(self, what=('videos', 'rgb_frames', 'flow_frames'), participants='all', specific_videos='all', splits='all',
+                 challenges='all', extension_only=False, epic55_only=False):
+        selection = dict(participants=participants, specific_videos=specific_videos, splits=splits,
+                         challenges=challenges, extension_only=extension_only, epic55_only=epic55_only)
+        self.print_selection('download', what, **selection)
+        self.run_downloads(self.plan(what, **selection))
+        self.report_failures()
+
+    def run_downloads(self, jobs):
+        # every download, whether it comes from download() or the download_<what> methods, goes through the journaled
+        # pipeline
+        journal_name = '.journal.sqlite' if self.shard is None else '.journal-shard-{}-of-{}.sqlite'.format(*self.shard)
+        self.journal = Journal(os.path.join(self.base_output, journal_name))
+        self.metrics.start()
+
+        try:
+            self.run_pipeline(jobs)
+        finally:
+            self.verification_cache.save()
+            self.remote_sizes.save()
+            self.transport.close()
+            self.metrics.close()
+            self.journal.close()
+
+    def verify(self, what=('videos', 'rgb_frames', 'flow_frames'), participants='all', specific_videos='all',
+               splits='all', challenges='all', extension_only=False, epic55_only=False, report_path=None):
+        # checks the local copy of every selected file against data/md5.csv, without downloading anything
+        selection = dict(participants=participants, specific_videos=specific_videos, splits=splits,
+                         challenges=challenges, extension_only=extension_only, epic55_only=epic55_only)
+        self.print_selection('verify', what, **selection)
+        jobs = list(self.plan(what, **selection))
+        self.metrics.start()
+
+        try:
+            # hashlib releases the GIL while hashing, so threads are enough to keep several disks/cores busy
+            with ThreadPoolExecutor(max_workers=self.hash_workers) as pool:
+                results = list(pool.map(self.verify_job, jobs))
+        finally:
+            self.verification_cache.save()
+            self.metrics.close()
+
+        summary = {status: 0 for status in ('ok', 'missing', 'mismatch', 'no_checksum')}
+
+        for r in results:
+            summary[r['status']] += 1
+
+        report_path = os.path.join(self.base_output, 'verify_report.json') if report_path is None else report_path
+        Path(os.path.dirname(os.path.abspath(report_path))).mkdir(parents=True, exist_ok=True)
+
+        with open(report_path, 'w') as f:
+            json.dump({'summary': summary, 'files': results}, f, indent=1)
+
+        print_header('| Verified {} files |'.format(len(results)), char='-')
+        print('ok: {ok}\nmissing: {missing}\nmismatch: {mismatch}\nno checksum known: {no_checksum}'.format(**summary))
+        print('Report written to {}'.format(report_path))
+
+        return summary
+
+    def verify_job(self, job):
+        expected_md5 = self.md5[job.version].get(job.remote_key)
+        result = {'path': job.output_path, 'remote_path': job.remote_key, 'expected_md5': expected_md5,
+                  'local_md5': None}
+
+        if self.extracts(job):
+            result['path'] = self.extraction_dir(job)
+            result['local_md5'] = self.extracted_md5(job)
+
+            if result['local_md5'] is None:
+                result['status'] = 'missing'
+            elif expected_md5 is None:
+                result['status'] = 'no_checksum'
+            else:
+                result['status'] = 'ok' if result['local_md5'] == expected_md5 else 'mismatch'
+        elif not os.path.exists(job.output_path):
+            result['status'] = 'missing'
+        elif expected_md5 is None:
+            result['status'] = 'no_checksum'
+        else:
+            # always hashed: the point of verifying is to catch files that changed without their size or modification
+            # time changing, which the verification cache cannot tell. The cache is refreshed with the result
+            result['local_md5'] = self.timed_hash_file(job.output_path).hexdigest()
+            self.verification_cache.put(job.output_path, result['local_md5'])
+            result['status'] = 'ok' if result['local_md5'] == expected_md5 else 'mismatch'
+
+        return result
+
+    def local_status(self, job):
+        # what we know about the local copy of a file without hashing it: missing, unverified (it exists but we do not
+        # have a valid checksum for it), mismatch (it is known to be corrupted or outdated) or verified
+        expected_md5 = self.md5[job.version].get(job.remote_key)
+
+        if self.extracts(job):
+            local_md5 = self.extracted_md5(job)
+
+            if local_md5 is None:
+                return 'missing'
+        elif not os.path.exists(job.output_path):
+            return 'missing'
+        else:
+            local_md5 = None if expected_md5 is None else self.verification_cache.get(job.output_path)
+
+        if local_md5 is None:
+            return 'unverified'
+
+        return 'verified' if local_md5 == expected_md5 else 'mismatch'
 
-            func = getattr(self, 'download_{}'.format(w))
-            func(video_dicts)
+    def fetch_remote_sizes(self, jobs):
+        missing = [job for job in jobs if self.remote_sizes.get(job.remote_key) is None]
+
+        def fetch(job):
+            with self.host_slot(job.url):
+                size, _ = self.remote_info(job.url)
+
+            if size is not None:
+                self.remote_sizes.put(job.remote_key, size)
+
+        if missing:
+            print('Asking the server the size of {} files...'.format(len(missing)))
+
+            with ThreadPoolExecutor(max_workers=self.max_connections_per_host) as pool:
+                list(pool.map(fetch, missing))
+
+            self.remote_sizes.save()
+
+    def measure_bandwidth(self, url, n_bytes=32 * 1024 ** 2):
+        # downloads (and discards) the first n_bytes of a file
+        start = time.monotonic()
+        received = 0
+
+        with self.host_slot(url), self.open_url(url, headers={'Range': 'bytes=0-{}'.format(n_bytes - 1)}) as response:
+            for chunk in iter(lambda: response.read(COPY_BUFSIZE), b''):
+                received += len(chunk)
+
+                if received >= n_bytes:
+                    break
+
+        return received / max(time.monotonic() - start, 1e-6)
+
+    def dry_run(self, what=('videos', 'rgb_frames', 'flow_frames'), participants='all', specific_videos='all',
+                splits='all', challenges='all', extension_only=False, epic55_only=False, fetch_sizes=False,
+                bandwidth=None):
+        # reports what download() would do without downloading anything. Sizes come from the sizes recorded by
+        # previous downloads and, with fetch_sizes, from HEAD requests for the files we do not know the size of
+        selection = dict(participants=participants, specific_videos=specific_videos, splits=splits,
+                         challenges=challenges, extension_only=extension_only, epic55_only=epic55_only)
+        self.print_selection('download (dry run)', what, **selection)
+        jobs = list(self.plan(what, write_manifest=False, **selection))
+        split_names = self.selected_splits(splits, challenges)
+
+        if fetch_sizes:
+            self.fetch_remote_sizes(jobs)
+
+        groups = {}
+        to_download = []  # files of known size that are not verified yet
+        columns = ('files', 'verified', 'unverified', 'mismatch', 'missing', 'unknown_size', 'total_bytes',
+                   'bytes_to_download')
+
+        for job in jobs:
+            status = self.local_status(job)
+            size = self.remote_sizes.get(job.remote_key)
+
+            if size and status != 'verified':
+                to_download.append(job)
+            mask = self.manifest.video_masks.get(job.video_id, 0)
+            names = [('total', 'all'), ('what', job.what)] + [('split', name) for name in split_names
+                                                             if mask & self.manifest.split_mask([name])]
+
+            for name in names:
+                row = groups.setdefault(name, dict.fromkeys(columns, 0))
+                row['files'] += 1
+                row[status] += 1
+
+                if size is None:
+                    row['unknown_size'] += 1
+                    continue
+
+                row['total_bytes'] += size
+
+                if status != 'verified':
+                    part_path = job.output_path + '.part'
+                    row['bytes_to_download'] += size - (os.path.getsize(part_path) if os.path.exists(part_path) else 0)
+
+        for kind, title in (('what', 'per data type'), ('split', 'per split'), ('total', 'total')):
+            print_header('| {} |'.format(title), char='-')
+            print('{:<32}{:>8}{:>10}{:>12}{:>10}{:>9}{:>14}{:>14}'.format(
+                '', 'files', 'verified', 'unverified', 'mismatch', 'missing', 'total size', 'to download'))
+
+            for (k, name), row in groups.items():
+                if k == kind:
+                    print('{:<32}{files:>8}{verified:>10}{unverified:>12}{mismatch:>10}{missing:>9}{:>14}{:>14}'.format(
+                        name, format_size(row['total_bytes']), format_size(row['bytes_to_download']), **row))
+
+        total = groups.get(('total', 'all'), dict.fromkeys(columns, 0))
+
+        if total['unknown_size']:
+            print('\nThe size of {} files is unknown, sizes above are underestimated.{}'.format(
+                total['unknown_size'], '' if fetch_sizes else ' Use --plan-sizes to ask the server for them'))
+
+        if bandwidth is None and fetch_sizes and to_download:
+            largest = max(to_download, key=lambda job: self.remote_sizes.get(job.remote_key))
+            bandwidth = self.measure_bandwidth(largest.url)
+            print('\nMeasured bandwidth: {}/s'.format(format_size(bandwidth)))
+
+        self.transport.close()
+
+        if bandwidth:
+            print('\nEstimated time to download {} at {}/s: {}'.format(
+                format_size(total['bytes_to_download']), format_size(bandwidth),
+                format_duration(total['bytes_to_download'] / bandwidth)))
+
+        return groups
+
+    def report_failures(self):
+        if not self.failed_downloads:
+            return
+
+        print_header('!!! {} file(s) could not be downloaded and verified !!!'.format(len(self.failed_downloads)),
+                     char='!')
+
+        for output_path, url, error in self.failed_downloads:
+            print('{}\n    from  {}\n    error {}'.format(output_path, url, error))
 
 
 def create_parser():
@@ -378,6 +2550,88 @@ def create_parser():
                         help='Download the smaller target test set used to validate hyper-parameters for domain '
                              'adaptation')
     parser.add_argument('--errata', action='store_true', help='Download only errata files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of files to download concurrently. Default is 1')
+    parser.add_argument('--max-connections-per-host', type=int, default=4,
+                        help='Maximum number of concurrent connections to the same host. Default is 4')
+    parser.add_argument('--max-inflight-bytes', type=parse_size, default=None,
+                        help='Cap on the total size of the files being downloaded at the same time, e.g. `50G`. '
+                             'Default is no cap')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Seconds to wait for the server before giving up on a connection. Default is 60')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='Number of idle connections kept alive per host and reused by following requests. '
+                             'Default is the value of --max-connections-per-host')
+    parser.add_argument('--no-keep-alive', action='store_true',
+                        help='Open a new connection for every file instead of reusing them')
+    parser.add_argument('--max-rate', type=parse_rate, default=None,
+                        help='Maximum overall download rate in bytes per second, e.g. `200M`, or bits per second, '
+                             'e.g. `500Mbit`. Default is no limit')
+    parser.add_argument('--max-host-rate', type=parse_host_rate, action='append', default=None,
+                        help='Maximum download rate from a given host, e.g. `data.bris.ac.uk=100M`. Can be repeated')
+    parser.add_argument('--rate-schedule', type=RateSchedule, default=None,
+                        help='Maximum download rate for daily time windows, e.g. '
+                             '`07:00-22:00=50Mbit,22:00-07:00=unlimited`. Outside of these windows --max-rate applies')
+    parser.add_argument('--segments', type=int, default=1,
+                        help='Download large files in this many byte ranges in parallel. Default is 1, i.e. a single '
+                             'stream per file')
+    parser.add_argument('--segment-threshold', type=parse_size, default='1G',
+                        help='Minimum file size for a file to be downloaded in segments. Default is 1G')
+    parser.add_argument('--reverify', action='store_true',
+                        help='Compute the md5 checksum of previously downloaded files even if they did not change '
+                             'since they were last verified. --verify-only always does')
+    parser.add_argument('--max-retries', type=int, default=3,
+                        help='How many times to try again a failed or corrupted download. Default is 3')
+    parser.add_argument('--retry-backoff', type=float, default=5,
+                        help='Seconds to wait before the first retry, doubling at every following one. Default is 5')
+    parser.add_argument('--extract', action='store_true',
+                        help='Extract rgb and flow frames while they are downloaded, instead of storing the tar files')
+    parser.add_argument('--index-frames', action='store_true',
+                        help='Write next to each downloaded tar an index of its frames (e.g. P01_01.tar.idx), to read '
+                             'them without extracting the tar')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='Download only a share of the selected files, given as INDEX/COUNT (e.g. `0/4`), to split '
+                             'a download across COUNT machines')
+    parser.add_argument('--shard-sizes', type=str, default=None,
+                        help='A json file mapping remote paths to file sizes, used to balance shards. All shards must '
+                             'use the same file')
+    parser.add_argument('--check-shards', nargs='+', default=None,
+                        help='Check that the given shard manifests together cover the whole selection, then exit')
+    parser.add_argument('--plan', '--dry-run', dest='plan', action='store_true',
+                        help='Do not download anything, report how many files would be downloaded and how many are '
+                             'already present and verified locally')
+    parser.add_argument('--plan-sizes', action='store_true',
+                        help='With --plan, ask the server the size of files whose size is not known yet and measure '
+                             'the bandwidth')
+    parser.add_argument('--bandwidth', type=parse_size, default=None,
+                        help='With --plan, the bandwidth (in bytes per second, e.g. `100M`) used to estimate the time '
+                             'needed to download the files')
+    parser.add_argument('--verify-only', action='store_true',
+                        help='Do not download anything, hash the selected local files and check them against their md5 '
+                             'checksums')
+    parser.add_argument('--hash-workers', type=int, default=None,
+                        help='Number of files to verify in parallel with --verify-only. Default is the number of CPUs')
+    parser.add_argument('--report', type=str, default=None,
+                        help='Where to write the JSON report of --verify-only. Default is '
+                             'EPIC-KITCHENS/verify_report.json under the output path')
+    parser.add_argument('--events', type=str, default=None,
+                        help='Append a JSON line to this file for every file started, finished, failed, skipped or '
+                             'hashed, and for the progress of running downloads')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='Write Prometheus metrics to this file, e.g. for the node exporter\'s textfile collector')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics over HTTP on this port at /metrics')
+    parser.add_argument('--metrics-host', type=str, default='127.0.0.1',
+                        help='Address the metrics server listens on with --metrics-port. Default is 127.0.0.1, i.e. '
+                             'only reachable from this machine. Use 0.0.0.0 to listen on all interfaces')
+    parser.add_argument('--mirror', dest='mirrors', action='append', default=None,
+                        help='A mirror to copy files from before downloading them, either a folder with files named '
+                             'after their md5 checksum (e.g. `ab/abcdef...`) or the url of a server with the same '
+                             'folders as the dataset. Can be repeated, mirrors are tried in the given order')
+    parser.add_argument('--populate-mirror', action='store_true',
+                        help='Add downloaded files to the first folder given with --mirror')
+    parser.add_argument('--metrics-interval', type=float, default=10,
+                        help='Seconds between progress events and updates of the metrics file. Default is 10')
 
     return parser
 
@@ -425,6 +2679,12 @@ def parse_args(parser):
     if args.errata:
         args.what = tuple(w for w in args.what if w != 'consent_forms')
 
+    assert not args.populate_mirror or any(urlparse(m).scheme not in ('http', 'https') for m in args.mirrors or []), \
+        '--populate-mirror requires a mirror folder given with --mirror'
+
+    if args.rate_schedule is not None:
+        args.rate_schedule.default = args.max_rate
+
     return args
 
 
@@ -437,8 +2697,37 @@ if __name__ == '__main__':
 
     print_header('*** Welcome to the EPIC Kitchens Downloader! ***')
 
-    downloader = EpicDownloader(base_output=args.output_path,  errata_only=args.errata)
-    downloader.download(what=args.what, participants=args.participants, specific_videos=args.specific_videos, splits=args.splits, challenges=args.challenges,
-                        extension_only=args.extension_only, epic55_only=args.epic55_only)
+    if args.check_shards is not None:
+        problems = check_shard_manifests(args.check_shards)
+        print('\n'.join(problems) if problems else 'The shards cover the whole selection')
+        sys.exit(1 if problems else 0)
+
+    downloader = EpicDownloader(base_output=args.output_path,  errata_only=args.errata, workers=args.workers,
+                                max_connections_per_host=args.max_connections_per_host,
+                                max_inflight_bytes=args.max_inflight_bytes, segments=args.segments,
+                                segment_threshold=args.segment_threshold, reverify=args.reverify,
+                                max_retries=args.max_retries, retry_backoff=args.retry_backoff,
+                                hash_workers=args.hash_workers, timeout=args.timeout, pool_size=args.pool_size,
+                                transport=UrllibTransport(timeout=args.timeout) if args.no_keep_alive else None,
+                                extract=args.extract, shard=args.shard, shard_sizes_path=args.shard_sizes,
+                                rate_limiter=RateLimiter(max_rate=args.max_rate, schedule=args.rate_schedule,
+                                                         host_rates=dict(args.max_host_rate or [])),
+                                metrics=Metrics(events_path=args.events, metrics_path=args.metrics_file,
+                                                metrics_port=args.metrics_port, metrics_host=args.metrics_host,
+                                                interval=args.metrics_interval),
+                                mirrors=args.mirrors, populate_mirror=args.populate_mirror,
+                                index_frames=args.index_frames)
+
+    if args.plan:
+        downloader.dry_run(what=args.what, participants=args.participants, specific_videos=args.specific_videos,
+                           splits=args.splits, challenges=args.challenges, extension_only=args.extension_only,
+                           epic55_only=args.epic55_only, fetch_sizes=args.plan_sizes, bandwidth=args.bandwidth)
+    elif args.verify_only:
+        downloader.verify(what=args.what, participants=args.participants, specific_videos=args.specific_videos,
+                          splits=args.splits, challenges=args.challenges, extension_only=args.extension_only,
+                          epic55_only=args.epic55_only, report_path=args.report)
+    else:
+        downloader.download(what=args.what, participants=args.participants, specific_videos=args.specific_videos, splits=args.splits, challenges=args.challenges,
+                            extension_only=args.extension_only, epic55_only=args.epic55_only)
 
     print_header('*** All done, bye! ***')
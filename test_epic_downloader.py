@@ -0,0 +1,575 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import hashlib
+import io
+import os
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from benchmark import SyntheticServer, synthetic_content
+from epic_downloader import (DownloadJob, EpicDownloader, FrameArchive, Journal, RateLimiter, RateSchedule, TarIndexer,
+                             TokenBucket, check_shard_manifests, parse_host_rate, parse_rate, read_frame_index, scan_tar,
+                             write_frame_index)
+
+# run with `python -m unittest`
+
+
+class FakeClock:
+    # a clock that only moves when something sleeps on it
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ParseRateTest(unittest.TestCase):
+    def test_rates(self):
+        self.assertEqual(parse_rate('200M'), 200 * 1024 ** 2)
+        self.assertEqual(parse_rate('200M/s'), 200 * 1024 ** 2)
+        self.assertEqual(parse_rate('50Mbit'), 50 * 1000 ** 2 / 8)
+        self.assertIsNone(parse_rate('unlimited'))
+        self.assertEqual(parse_host_rate('data.bris.ac.uk=10M'), ('data.bris.ac.uk', 10 * 1024 ** 2))
+
+    def test_rejects_rates_that_are_not_positive(self):
+        for rate in ('0', '-5M', '0bit', '0M/s'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_rate(rate)
+
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_host_rate('data.bris.ac.uk=0')
+
+        with self.assertRaises(argparse.ArgumentTypeError):
+            RateSchedule('07:00-22:00=0,22:00-07:00=unlimited')
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_blocks_to_keep_the_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1024 ** 2, clock=clock, sleep=clock.sleep)
+
+        for _ in range(10):
+            bucket.consume(512 * 1024)
+
+        self.assertAlmostEqual(clock.now, 5.0)
+
+    def test_allows_a_burst_after_idling(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1024 ** 2, clock=clock, sleep=clock.sleep)
+        clock.now += 60  # idle time only ever buys a second worth of data
+        bucket.consume(1024 ** 2)
+        self.assertEqual(clock.sleeps, [])
+        bucket.consume(1024 ** 2)
+        self.assertAlmostEqual(clock.now, 61.0)
+
+    def test_rate_changes_apply_to_the_next_chunk(self):
+        clock = FakeClock()
+        rate = [1024 ** 2]
+        bucket = TokenBucket(lambda: rate[0], clock=clock, sleep=clock.sleep)
+        bucket.consume(1024 ** 2)
+        self.assertAlmostEqual(clock.now, 1.0)
+        rate[0] = None
+        bucket.consume(100 * 1024 ** 2)
+        self.assertAlmostEqual(clock.now, 1.0)
+        rate[0] = 2 * 1024 ** 2
+        bucket.consume(2 * 1024 ** 2)
+        self.assertAlmostEqual(clock.now, 2.0)
+
+    def test_rates_that_are_not_positive_do_not_divide_by_zero(self):
+        clock = FakeClock()
+        bucket = TokenBucket(0, clock=clock, sleep=clock.sleep)
+        bucket.consume(1024 ** 2)
+        self.assertEqual(clock.sleeps, [])
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_host_and_global_budgets(self):
+        clock = FakeClock()
+        limiter = RateLimiter(max_rate=2 * 1024 ** 2, host_rates={'slow': 1024 ** 2}, clock=clock, sleep=clock.sleep)
+
+        for _ in range(4):
+            limiter.consume('slow', 1024 ** 2)
+
+        # the host's own bucket is the tighter one
+        self.assertAlmostEqual(clock.now, 4.0)
+
+        clock = FakeClock()
+        limiter = RateLimiter(max_rate=2 * 1024 ** 2, host_rates={'slow': 1024 ** 2}, clock=clock, sleep=clock.sleep)
+
+        for host in ('a', 'b', 'c', 'd'):
+            limiter.consume(host, 1024 ** 2)
+
+        # all other hosts share the global budget
+        self.assertAlmostEqual(clock.now, 2.0)
+
+    def test_schedule(self):
+        clock = FakeClock()
+        now = [datetime.datetime(2020, 1, 1, 12, 0)]
+        schedule = RateSchedule('07:00-22:00=1M,22:00-07:00=unlimited')
+        limiter = RateLimiter(schedule=schedule, clock=clock, sleep=clock.sleep, now=lambda: now[0])
+
+        for _ in range(3):
+            limiter.consume('host', 1024 ** 2)
+
+        self.assertAlmostEqual(clock.now, 3.0)
+        now[0] = datetime.datetime(2020, 1, 1, 23, 0)
+
+        for _ in range(3):
+            limiter.consume('host', 1024 ** 2)
+
+        self.assertAlmostEqual(clock.now, 3.0)
+
+
+class ManifestTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.downloader = EpicDownloader(base_output=cls.tmp.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def video_ids(self, **kwargs):
+        return {job.video_id for job in self.downloader.plan(('videos',), **kwargs)}
+
+    def test_selection_matches_the_split_lists(self):
+        for challenge_split, videos in self.downloader.videos_per_split.items():
+            challenge, _, split = challenge_split.partition('_')
+
+            if challenge != 'da':  # the names of domain adaptation splits also match longer ones, e.g. val_source_train
+                with self.subTest(split=challenge_split):
+                    self.assertEqual(self.video_ids(challenges=[challenge], splits=[split]),
+                                     {v['video_id'] for v in videos})
+
+    def test_participants_and_specific_videos(self):
+        p01 = {v for v in self.video_ids() if v.startswith('P01_')}
+        self.assertEqual(self.video_ids(participants=[1]), p01)
+        self.assertEqual(self.video_ids(participants=['P01'], specific_videos=['P02_01']), p01 | {'P02_01'})
+        self.assertEqual(self.video_ids(specific_videos=['P02_01', 'P30_101']), {'P02_01', 'P30_101'})
+
+    def test_extension_and_epic_55(self):
+        extension = self.video_ids(extension_only=True)
+        epic_55 = self.video_ids(epic55_only=True)
+        self.assertFalse(extension & epic_55)
+        self.assertEqual(extension | epic_55, self.video_ids())
+        self.assertTrue(all(len(v.split('_')[1]) == 3 for v in extension))
+
+    def test_jobs(self):
+        jobs = {(job.what, job.video_id): job for job in self.downloader.plan(self.downloader.manifest_what)}
+        video = jobs['videos', 'P01_01']
+        self.assertEqual(video.url, self.downloader.base_url_55 + '/videos/train/P01/P01_01.MP4')
+        self.assertEqual(video.output_path, os.path.join(self.downloader.base_output, 'P01', 'videos', 'P01_01.MP4'))
+        self.assertEqual(jobs['rgb_frames', 'P01_109'].version, 'errata')
+        self.assertNotIn(('metadata', 'P01_01'), jobs)
+        self.assertNotIn(('object_detection_images', 'P01_101'), jobs)
+
+
+class VerifyTest(unittest.TestCase):
+    def test_files_are_hashed_even_if_cached(self):
+        with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+            downloader = EpicDownloader(base_output=tmp)
+            path = os.path.join(downloader.base_output, 'P01', 'videos', 'P01_01.MP4')
+            job = DownloadJob('https://example.com/P01_01.MP4', path, 'P01_01.MP4', '55', video_id='P01_01',
+                              what='videos')
+            content = synthetic_content('P01_01', 64 * 1024)
+            downloader.md5['55'][job.remote_key] = hashlib.md5(content).hexdigest()
+            os.makedirs(os.path.dirname(path))
+
+            with open(path, 'wb') as f:
+                f.write(content)
+
+            self.assertEqual(downloader.verify_job(job)['status'], 'ok')
+
+            # corrupted without its size or modification time changing, so the cache still has an entry for it
+            st = os.stat(path)
+
+            with open(path, 'r+b') as f:
+                f.write(b'x')
+
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(downloader.verification_cache.get(path), downloader.md5['55'][job.remote_key])
+            self.assertEqual(downloader.verify_job(job)['status'], 'mismatch')
+            self.assertEqual(downloader.local_status(job), 'mismatch')
+
+
+class ShardTest(unittest.TestCase):
+    what = ('videos', 'rgb_frames', 'flow_frames')
+    count = 4
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.downloader = EpicDownloader(base_output=self.tmp.name)
+        self.jobs = list(self.downloader.plan(self.what, participants=['P01', 'P02']))
+        self.manifest_dir = os.path.join(self.downloader.base_output, 'shards')
+
+    def shard(self, index):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.downloader.shard_jobs(self.jobs, index, self.count)
+
+    def test_shards_cover_the_selection_once(self):
+        shards = [self.shard(i) for i in range(self.count)]
+        keys = [job.remote_key for shard in shards for job in shard]
+        self.assertEqual(sorted(keys), sorted(job.remote_key for job in self.jobs))
+        self.assertTrue(all(shards))
+
+        manifests = sorted(glob.glob(os.path.join(self.manifest_dir, '*.json')))
+        self.assertEqual(len(manifests), self.count)
+        self.assertEqual(check_shard_manifests(manifests), [])
+
+    def test_shards_match_plan(self):
+        for i in range(self.count):
+            with self.subTest(shard=i), contextlib.redirect_stdout(io.StringIO()):
+                downloader = EpicDownloader(base_output=self.tmp.name, shard=(i, self.count))
+                planned = [job.remote_key for job in downloader.plan(self.what, participants=['P01', 'P02'])]
+                self.assertEqual(planned, [job.remote_key for job in self.shard(i)])
+
+    def test_dry_runs_do_not_write_manifests(self):
+        downloader = EpicDownloader(base_output=self.tmp.name, shard=(0, self.count))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            planned = [job.remote_key for job in downloader.plan(self.what, participants=['P01', 'P02'],
+                                                                 write_manifest=False)]
+            downloader.dry_run(self.what, participants=['P01', 'P02'])
+
+        self.assertFalse(os.path.exists(self.manifest_dir))
+        self.assertEqual(planned, [job.remote_key for job in self.shard(0)])
+
+    def test_problems_are_reported(self):
+        shards = [self.shard(i) for i in range(self.count - 1)]
+        manifests = sorted(glob.glob(os.path.join(self.manifest_dir, '*.json')))
+        self.assertEqual(check_shard_manifests(manifests), ['missing manifests for shards 3'])
+        self.assertEqual(check_shard_manifests(manifests + manifests[:1]),
+                         ['missing manifests for shards 3',
+                          'shard 0 shares {} files with other shards'.format(len(shards[0]))])
+
+        self.jobs = self.jobs[1:]
+        self.shard(3)
+        manifests = sorted(glob.glob(os.path.join(self.manifest_dir, '*.json')))
+        self.assertIn('shard 3/4 was planned for a different selection or number of shards',
+                      check_shard_manifests(manifests))
+        self.assertEqual(check_shard_manifests([]), ['no shard manifests given'])
+
+
+class TransferTest(unittest.TestCase):
+    # downloads a file from a local server that handles Range requests in the given way
+    name = 'file.bin'
+    size = 300 * 1024
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = os.path.join(self.tmp.name, 'server')
+        os.mkdir(self.root)
+        self.content = self.make_content()
+
+        with open(os.path.join(self.root, self.name), 'wb') as f:
+            f.write(self.content)
+
+        self.output_path = os.path.join(self.tmp.name, 'output', self.name)
+        self.part_path = self.output_path + '.part'
+        os.mkdir(os.path.dirname(self.output_path))
+        self.server = None
+
+    def make_content(self):
+        return synthetic_content('file', self.size)
+
+    def tearDown(self):
+        self.stop_server()
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def start_server(self, **kwargs):
+        self.server = SyntheticServer(('127.0.0.1', 0), self.root, **kwargs)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        return 'http://127.0.0.1:{}/{}'.format(self.server.server_address[1], self.name)
+
+    def download(self, url, size=None, large=True, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloader = EpicDownloader(base_output=self.tmp.name, retry_backoff=0, **kwargs)
+            result = downloader.download_file(url, self.output_path, hashlib.md5(self.content).hexdigest(),
+                                              size=size, large=large)
+            downloader.transport.close()
+
+        self.assertIs(result, True)
+        self.assertFalse(os.path.exists(self.part_path))
+        self.assertFalse(os.path.exists(self.part_path + '.segments'))
+
+        with open(self.output_path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+        return [(method, range_header, status) for method, _, range_header, status in self.server.served]
+
+    def write_part(self, data):
+        with open(self.part_path, 'wb') as f:
+            f.write(data)
+
+
+class ResumeTest(TransferTest):
+    def test_resumes_an_interrupted_download(self):
+        url = self.start_server(disconnect_every=2)
+        self.server.responses = 1  # the first response is the one cut halfway through
+        served = self.download(url)
+        self.assertEqual(served, [('GET', None, 200), ('GET', 'bytes={}-'.format(self.size // 2), 206)])
+
+    def test_resumes_an_existing_part_file(self):
+        self.write_part(self.content[:100 * 1024])
+        served = self.download(self.start_server())
+        self.assertEqual(served, [('GET', 'bytes=102400-', 206)])
+
+    def test_starts_over_when_ranges_are_ignored(self):
+        self.write_part(self.content[:100 * 1024])
+        served = self.download(self.start_server(ranges='ignore'))
+        self.assertEqual(served, [('GET', 'bytes=102400-', 200)])
+
+    def test_starts_over_when_ranges_are_rejected(self):
+        self.write_part(self.content[:100 * 1024])
+        served = self.download(self.start_server(ranges='reject'))
+        self.assertEqual(served, [('GET', 'bytes=102400-', 416), ('GET', None, 200)])
+
+    def test_starts_over_when_the_content_range_does_not_match(self):
+        self.write_part(self.content[:100 * 1024])
+        served = self.download(self.start_server(ranges='misalign'))
+        self.assertEqual(served, [('GET', 'bytes=102400-', 206), ('GET', None, 200)])
+
+    def test_starts_over_when_the_part_file_is_corrupt(self):
+        self.write_part(b'x' * 100 * 1024)
+        served = self.download(self.start_server())
+        self.assertEqual(served, [('GET', 'bytes=102400-', 206), ('GET', None, 200)])
+
+
+class SegmentedTest(TransferTest):
+    segmented = dict(segments=4, segment_threshold=100 * 1024, max_connections_per_host=4)
+
+    def test_downloads_in_segments(self):
+        served = self.download(self.start_server(), **self.segmented)
+        self.assertEqual(served[0], ('HEAD', None, 200))
+        self.assertEqual(sorted(served[1:]), [('GET', 'bytes=0-76799', 206), ('GET', 'bytes=153600-230399', 206),
+                                              ('GET', 'bytes=230400-307199', 206), ('GET', 'bytes=76800-153599', 206)])
+
+    def test_falls_back_to_a_single_stream(self):
+        for ranges, status in (('ignore', 200), ('reject', 416), ('misalign', 206)):
+            with self.subTest(ranges=ranges):
+                served = self.download(self.start_server(ranges=ranges), **self.segmented)
+                self.stop_server()
+                self.assertEqual(served[0], ('HEAD', None, 200))
+                self.assertEqual({s for _, _, s in served[1:-1]}, {status})
+                self.assertEqual(served[-1], ('GET', None, 200))
+                os.remove(self.output_path)
+
+    def test_small_files_are_downloaded_without_a_head_request(self):
+        url = self.start_server()
+        self.assertEqual(self.download(url, large=False, **self.segmented), [('GET', None, 200)])
+        os.remove(self.output_path)
+        self.server.served.clear()
+        self.assertEqual(self.download(url, size=self.size, segments=4), [('GET', None, 200)])
+
+
+class ExtractTest(TransferTest):
+    def test_members_written_through_links_are_rejected(self):
+        outside = os.path.join(self.tmp.name, 'outside')
+        os.mkdir(outside)
+
+        with tarfile.open(os.path.join(self.root, 'evil.tar'), 'w') as tar:
+            link = tarfile.TarInfo('link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = outside
+            tar.addfile(link)
+            info = tarfile.TarInfo('link/owned.txt')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'owned'))
+
+        url = self.start_server().replace(self.name, 'evil.tar')
+        data_filter = tarfile.__dict__.get('data_filter')
+
+        for with_filter in (True, False):
+            with self.subTest(data_filter=with_filter):
+                if data_filter is None and with_filter:
+                    continue
+
+                if not with_filter and data_filter is not None:
+                    del tarfile.data_filter
+                    self.addCleanup(setattr, tarfile, 'data_filter', data_filter)
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    downloader = EpicDownloader(base_output=self.tmp.name, max_retries=0)
+                    result = downloader.download_extracted(url, os.path.join(self.tmp.name, 'frames'))
+                    downloader.transport.close()
+
+                self.assertIs(result, False)
+                self.assertEqual(os.listdir(outside), [])
+
+
+class JournalTest(TransferTest):
+    # runs a download through the pipeline, starting from the given journal state
+    def run_pipeline(self, state=None):
+        url = self.start_server()
+        job = DownloadJob(url, self.output_path, self.name, '55', video_id='P01_01', what='videos')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloader = EpicDownloader(base_output=self.tmp.name, retry_backoff=0)
+            downloader.md5['55'][self.name] = hashlib.md5(self.content).hexdigest()
+            journal_path = os.path.join(downloader.base_output, '.journal.sqlite')
+
+            if state is not None:
+                journal = Journal(journal_path)
+                journal.set(job, state)
+                journal.close()
+
+            downloader.run_downloads([job])
+
+        journal = Journal(journal_path)
+        self.addCleanup(journal.close)
+        self.assertEqual(journal.state(job), 'done')
+        self.assertEqual(downloader.failed_downloads, [])
+        self.assertFalse(os.path.exists(self.part_path))
+
+        with open(self.output_path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+        served = [(method, range_header, status) for method, _, range_header, status in self.server.served]
+        self.stop_server()
+        return served
+
+    def test_fetched_jobs_are_only_verified(self):
+        self.write_part(self.content)
+        self.assertEqual(self.run_pipeline('fetched'), [])
+
+    def test_fetching_jobs_resume(self):
+        self.write_part(self.content[:100 * 1024])
+        self.assertEqual(self.run_pipeline('fetching'), [('GET', 'bytes=102400-', 206)])
+
+    def test_corrupt_fetched_jobs_are_downloaded_again(self):
+        self.write_part(b'x' * self.size)
+        self.assertEqual(self.run_pipeline('fetched'), [('GET', None, 200)])
+
+    def test_done_jobs_are_skipped(self):
+        self.assertEqual(self.run_pipeline(), [('GET', None, 200)])
+        self.assertEqual(self.run_pipeline(), [])
+
+
+def make_tar(tar_format):
+    # frames of awkward sizes, a folder, a link and names too long for a plain tar header, which GNU, pax and ustar
+    # archives each store in their own way
+    output = io.BytesIO()
+    pax_headers = {'comment': 'global header'} if tar_format == tarfile.PAX_FORMAT else None
+
+    with tarfile.open(fileobj=output, mode='w', format=tar_format, pax_headers=pax_headers) as tar:
+        folder = tarfile.TarInfo('./frames')
+        folder.type = tarfile.DIRTYPE
+        tar.addfile(folder)
+        names = ['./frame_{:010d}.jpg'.format(i) for i in range(1, 7)]
+        names += ['./{}/{}.jpg'.format('d' * 60, 'n' * 90), './frame_\u00e9.jpg']
+
+        for name, size in zip(names, (0, 1, 511, 512, 513, 5000, 700, 20)):
+            info = tarfile.TarInfo(name)
+            info.size = size
+            tar.addfile(info, io.BytesIO(synthetic_content(name, size)))
+
+        link = tarfile.TarInfo('./link.jpg')
+        link.type = tarfile.SYMTYPE
+        link.linkname = names[0]
+        tar.addfile(link)
+
+    return output.getvalue()
+
+
+class TarIndexerTest(unittest.TestCase):
+    formats = {'gnu': tarfile.GNU_FORMAT, 'pax': tarfile.PAX_FORMAT, 'ustar': tarfile.USTAR_FORMAT}
+
+    def test_matches_tarfile_whatever_the_chunk_size(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for format_name, tar_format in self.formats.items():
+                path = os.path.join(tmp, '{}.tar'.format(format_name))
+
+                with open(path, 'wb') as f:
+                    f.write(make_tar(tar_format))
+
+                with open(path, 'rb') as f:
+                    data = f.read()
+
+                expected = scan_tar(path)
+                self.assertEqual(len(expected), 8)
+
+                for chunk_size in (1, 7, 511, 512, 513, 4099, len(data)):
+                    with self.subTest(format=format_name, chunk_size=chunk_size):
+                        indexer = TarIndexer()
+
+                        for start in range(0, len(data), chunk_size):
+                            indexer.feed(data[start:start + chunk_size])
+
+                        self.assertIsNone(indexer.error)
+                        self.assertTrue(indexer.complete)
+                        self.assertEqual(indexer.entries, expected)
+
+    def test_other_data_is_an_error(self):
+        indexer = TarIndexer()
+        indexer.feed(synthetic_content('not a tar', 2048))
+        self.assertIsNotNone(indexer.error)
+        self.assertFalse(indexer.complete)
+
+
+class FrameIndexTest(TransferTest):
+    name = 'frames.tar'
+
+    def make_content(self):
+        return make_tar(tarfile.GNU_FORMAT)
+
+    def check_frames(self, tar_path):
+        with tarfile.open(tar_path) as tar, FrameArchive(tar_path) as frames:
+            members = [m for m in tar if m.isreg()]
+            self.assertEqual(len(frames), len(members))
+
+            for member in members:
+                self.assertIn(member.name, frames)
+                frame = frames[member.name]
+                self.assertEqual(frame.tobytes(), tar.extractfile(member).read())
+                frame.release()
+
+            self.assertNotIn('link.jpg', frames)
+
+    def test_round_trip(self):
+        tar_path = os.path.join(self.root, self.name)
+        write_frame_index(tar_path + '.idx', scan_tar(tar_path), len(self.content))
+        self.check_frames(tar_path)
+        self.assertIn('frame_0000000001.jpg', read_frame_index(tar_path + '.idx'))
+
+        with self.assertRaises(ValueError):
+            read_frame_index(tar_path + '.idx', len(self.content) + 1)
+
+    def test_index_is_built_while_downloading(self):
+        served = self.download(self.start_server(), index_frames=True)
+        self.assertEqual(served, [('GET', None, 200)])
+        self.assertFalse(os.path.exists(self.part_path + '.idx'))
+        self.check_frames(self.output_path)
+
+    def test_resumed_download_is_indexed_once_complete(self):
+        self.write_part(self.content[:3000])
+        url = self.start_server()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloader = EpicDownloader(base_output=self.tmp.name, retry_backoff=0, index_frames=True)
+            self.assertIs(downloader.download_file(url, self.output_path), True)
+            self.assertFalse(os.path.exists(self.output_path + '.idx'))
+            downloader.ensure_frame_index(self.output_path)
+            downloader.transport.close()
+
+        self.check_frames(self.output_path)
+
+
+if __name__ == '__main__':
+    unittest.main()